@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency of the hot database lookups with and without the indexes of
+`models`.
+A synthetic dataset of several campaigns (pawprints in different states,
+their sources and candidates, and calibration frames) is loaded into a
+fresh SQLite database without any secondary index. Each query is timed,
+the indexes are built, and the queries are timed again; the query plans
+show which lookups scan a table and which seek an index.
+"""
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import datetime
+import os
+import tempfile
+import time
+
+import numpy as np
+import sqlalchemy as sa
+
+import models
+from ingest import ingest_frames, load_candidates, load_sources
+from scheduler import Scheduler
+
+_START = datetime.datetime(2015, 9, 1, 0, 0, 0)
+_JD_START = 2457266.5
+
+_CALIBRATION_FRAMES = [('bias', 0), ('dark', 30), ('dark', 60),
+                       ('dark', 120), ('flat', 5)]
+
+
+def frameRows(rng, campaign, npawprints):
+    """
+    Header rows of the pawprints of a campaign, a few per night.
+    """
+    offsets = np.sort(rng.uniform(0, 120, npawprints))
+    for num, offset in enumerate(offsets):
+        yield {'file': 'campaign%d/pawprint%06d.fit' % (campaign, num),
+               'imagetyp': 'Light Frame', 'exptime': 60.,
+               'date-obs': (_START + datetime.timedelta(days=offset))
+                           .strftime('%Y-%m-%dT%H:%M:%S'),
+               'jd': _JD_START + offset, 'ccd-temp': -20.,
+               'xbinning': 1, 'ybinning': 1,
+               'object': 'field%d' % campaign}
+
+
+def calibrationRows(rng, ncalfiles):
+    """
+    Header rows of calibration frames over the same nights.
+    """
+    offsets = np.sort(rng.uniform(0, 120, ncalfiles))
+    kinds = rng.randint(len(_CALIBRATION_FRAMES), size=ncalfiles)
+    for num, (offset, kind) in enumerate(zip(offsets, kinds)):
+        imagetype, exptime = _CALIBRATION_FRAMES[kind]
+        yield {'file': 'calibration/%s%06d.fit' % (imagetype, num),
+               'imagetyp': imagetype.title() + ' Frame', 'exptime': exptime,
+               'date-obs': (_START + datetime.timedelta(days=offset))
+                           .strftime('%Y-%m-%dT%H:%M:%S'),
+               'jd': _JD_START + offset, 'ccd-temp': -20.,
+               'xbinning': 1, 'ybinning': 1}
+
+
+def catalog(rng, ra, dec, nrows):
+    """
+    Detections scattered around ``(ra, dec)``.
+    """
+    rows = np.zeros(nrows, dtype=[('ra', float), ('dec', float),
+                                  ('mag', float), ('mag_err', float)])
+    rows['ra'] = ra + rng.uniform(-0.5, 0.5, nrows)
+    rows['dec'] = dec + rng.uniform(-0.5, 0.5, nrows)
+    rows['mag'] = rng.uniform(12, 20, nrows)
+    rows['mag_err'] = rng.uniform(0.01, 0.2, nrows)
+    return rows
+
+
+def loadDataset(engine, ncampaigns, npawprints, nsources, ncandidates,
+                ncalfiles, seed=0):
+    """
+    Fill a database with synthetic data.
+    Returns the ids of the campaigns and of the pawprints.
+    """
+    rng = np.random.RandomState(seed)
+    with engine.begin() as connection:
+        campaign_ids = [connection.execute(
+            models.Campaign.__table__.insert(),
+            {'name': 'campaign%d' % num}).inserted_primary_key[0]
+            for num in range(ncampaigns)]
+
+    for num, campaign_id in enumerate(campaign_ids):
+        ingest_frames(engine, frameRows(rng, num, npawprints),
+                      campaign_id=campaign_id)
+    ingest_frames(engine, calibrationRows(rng, ncalfiles))
+
+    # move pawprints along the pipeline, so they are spread over states
+    scheduler = Scheduler(engine)
+    total = ncampaigns * npawprints
+    while scheduler.count('raw') > total // 4:
+        claimed = scheduler.claim('raw', 'preprocessing', batch_size=500)
+        done = [pawprint_id for pawprint_id in claimed
+                if rng.uniform() < 0.9]
+        scheduler.transition(done, 'preprocessed')
+        scheduler.transition(sorted(set(claimed) - set(done)), 'failed')
+
+    pawprints = models.Pawprint.__table__
+    with engine.connect() as connection:
+        rows = connection.execute(sa.select(pawprints.c.id,
+                                            pawprints.c.campaign_id)).all()
+    pawprint_ids = [row.id for row in rows]
+    for pawprint_id, campaign_id in rows:
+        ra, dec = 15. * campaign_id, -30.
+        load_sources(engine, catalog(rng, ra, dec, nsources), pawprint_id)
+        if ncandidates:
+            load_candidates(engine, catalog(rng, ra, dec, ncandidates),
+                            pawprint_id=pawprint_id)
+    return campaign_ids, pawprint_ids
+
+
+def benchmarkQueries(engine, campaign_ids, pawprint_ids, rng):
+    """
+    The lookups to time, as ``(name, statement)`` pairs; each call picks
+    new random keys.
+    """
+    pawprints = models.Pawprint.__table__
+    statechanges = models.StateChange.__table__
+    sources = models.Source.__table__
+    candidates = models.Candidate.__table__
+    calfiles = models.CalFile.__table__
+    scheduler = Scheduler(engine)
+
+    pawprint_id = pawprint_ids[rng.randint(len(pawprint_ids))]
+    campaign_id = campaign_ids[rng.randint(len(campaign_ids))]
+    jd = _JD_START + rng.uniform(0, 119)
+    date = _START + datetime.timedelta(days=rng.uniform(0, 119))
+    imagetype, exptime = _CALIBRATION_FRAMES[
+        rng.randint(len(_CALIBRATION_FRAMES))]
+    state = ['raw', 'preprocessed', 'failed'][rng.randint(3)]
+
+    return [
+        ('pawprints by state', sa.select(pawprints)
+         .where(pawprints.c.state_id == scheduler.state_id(state))
+         .order_by(pawprints.c.modified_at).limit(100)),
+        ('pawprints by campaign', sa.select(pawprints)
+         .where(pawprints.c.campaign_id == campaign_id)
+         .order_by(pawprints.c.jd)),
+        ('pawprints of a night', sa.select(pawprints)
+         .where(pawprints.c.jd.between(jd, jd + 1))),
+        ('state changes of a pawprint', sa.select(statechanges)
+         .where(statechanges.c.pawprint_id == pawprint_id)),
+        ('sources of a pawprint', sa.select(sources)
+         .where(sources.c.pawprint_id == pawprint_id)),
+        ('candidates of a pawprint', sa.select(candidates)
+         .where(candidates.c.pawprint_id == pawprint_id)),
+        ('calibration frames', sa.select(calfiles)
+         .where(calfiles.c.imagetype == imagetype)
+         .where(calfiles.c.exptime == exptime)
+         .where(calfiles.c.observation_date.between(
+             date - datetime.timedelta(days=1),
+             date + datetime.timedelta(days=1)))),
+    ]
+
+
+def queryPlan(connection, statement):
+    """
+    SQLite query plan of a statement, one step per line.
+    """
+    compiled = statement.compile(dialect=connection.dialect)
+    params = compiled.construct_params()
+    params = tuple(str(params[name]) if isinstance(params[name],
+                                                   datetime.datetime)
+                   else params[name] for name in compiled.positiontup)
+    plan = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + compiled.string,
+                                      params).fetchall()
+    return [row[-1] for row in plan]
+
+
+def timeQueries(engine, campaign_ids, pawprint_ids, repeat, seed=1):
+    """
+    Median latency in seconds, mean number of rows and query plan of each
+    lookup.
+    Raises RuntimeError if a lookup finds no rows at all, as its timing
+    would then only measure an empty probe.
+    """
+    rng = np.random.RandomState(seed)
+    timings = {}
+    rows = {}
+    plans = {}
+    with engine.connect() as connection:
+        for _ in range(repeat):
+            for name, statement in benchmarkQueries(engine, campaign_ids,
+                                                    pawprint_ids, rng):
+                start = time.time()
+                result = connection.execute(statement).fetchall()
+                timings.setdefault(name, []).append(time.time() - start)
+                rows.setdefault(name, []).append(len(result))
+                if name not in plans:
+                    plans[name] = queryPlan(connection, statement)
+    for name, counts in rows.items():
+        if not sum(counts):
+            raise RuntimeError('Query {!r} found no rows in {} runs'.format(
+                name, len(counts)))
+    return [(name, np.median(values), np.mean(rows[name]), plans[name])
+            for name, values in timings.items()]
+
+
+def secondaryIndexes():
+    """
+    Indexes of `models` other than primary keys and unique constraints.
+    """
+    return [index for table in models.Model.metadata.sorted_tables
+            for index in table.indexes]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument("--campaigns", type=int, default=4,
+        help="Number of campaigns.")
+    parser.add_argument("--pawprints", type=int, default=500,
+        help="Number of pawprints of each campaign.")
+    parser.add_argument("--sources", type=int, default=500,
+        help="Number of sources of each pawprint.")
+    parser.add_argument("--candidates", type=int, default=20,
+        help="Number of candidates of each pawprint.")
+    parser.add_argument("--calfiles", type=int, default=5000,
+        help="Number of calibration frames.")
+    parser.add_argument("--repeat", type=int, default=20,
+        help="Number of times each query is timed, with different keys.")
+    parser.add_argument("--db", default=None,
+        help="SQLite file to build the dataset in; a temporary file by "
+             "default.")
+    args = parser.parse_args()
+
+    dbpath = args.db
+    if dbpath is None:
+        dbpath = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+    engine = sa.create_engine('sqlite:///' + dbpath)
+
+    indexes = secondaryIndexes()
+    models.Model.metadata.create_all(engine)
+    for index in indexes:
+        index.drop(engine)
+
+    start = time.time()
+    campaign_ids, pawprint_ids = loadDataset(
+        engine, args.campaigns, args.pawprints, args.sources,
+        args.candidates, args.calfiles)
+    print("Loaded %d campaigns, %d pawprints, %d sources in %.1f s (%s)" % (
+        len(campaign_ids), len(pawprint_ids),
+        len(pawprint_ids) * args.sources, time.time() - start, dbpath))
+
+    before = timeQueries(engine, campaign_ids, pawprint_ids, args.repeat)
+    start = time.time()
+    for index in indexes:
+        index.create(engine)
+    with engine.begin() as connection:
+        connection.exec_driver_sql('ANALYZE')
+    print("Built %d indexes in %.1f s" % (len(indexes), time.time() - start))
+    after = timeQueries(engine, campaign_ids, pawprint_ids, args.repeat)
+
+    print()
+    print("%-30s %8s %12s %12s %9s" % ('query', 'rows', 'before [ms]',
+                                        'after [ms]', 'speedup'))
+    for (name, old, nrows, old_plan), (_, new, _, new_plan) in zip(before,
+                                                                   after):
+        print("%-30s %8.1f %12.3f %12.3f %8.0fx" % (name, nrows, 1e3 * old,
+                                                    1e3 * new, old / new))
+        print("    before: %s" % '; '.join(old_plan))
+        print("    after:  %s" % '; '.join(new_plan))
@@ -0,0 +1,226 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import bisect
+import datetime
+import logging
+from collections import namedtuple
+
+import models
+from models import calibration_imagetype
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['CalibrationLibrary', 'LibraryMaster']
+
+#: Entry of the in-memory index of a `CalibrationLibrary`.
+LibraryMaster = namedtuple('LibraryMaster',
+                           ['id', 'path', 'imagetype', 'observation_date',
+                            'exptime', 'ccdtemp', 'xbinning', 'ybinning'])
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _timestamp(date):
+    if date.tzinfo is not None:
+        date = date.replace(tzinfo=None) - date.utcoffset()
+    return (date - _EPOCH).total_seconds()
+
+
+class _MasterGroup(object):
+
+    """
+    Masters of one image type, binning and (for darks) exposure time,
+    sorted by observation date.
+    """
+
+    def __init__(self):
+        self.times = []
+        self.masters = []
+
+    def add(self, master):
+        time = _timestamp(master.observation_date)
+        idx = bisect.bisect_right(self.times, time)
+        self.times.insert(idx, time)
+        self.masters.insert(idx, master)
+
+    def closest(self, time, max_age=None, ccdtemp=None, max_temp_diff=None):
+        """
+        Master closest in time to ``time`` (in seconds), skipping masters
+        older or newer than ``max_age`` seconds or with a CCD temperature
+        more than ``max_temp_diff`` away from ``ccdtemp``.
+        """
+        after = bisect.bisect_left(self.times, time)
+        before = after - 1
+        while before >= 0 or after < len(self.times):
+            if after >= len(self.times) or (
+                    before >= 0 and
+                    time - self.times[before] <= self.times[after] - time):
+                idx = before
+                before -= 1
+            else:
+                idx = after
+                after += 1
+            if max_age is not None and abs(self.times[idx] - time) > max_age:
+                return None
+            master = self.masters[idx]
+            if (max_temp_diff is None or ccdtemp is None or
+                    master.ccdtemp is None or
+                    abs(master.ccdtemp - ccdtemp) <= max_temp_diff):
+                return master
+        return None
+
+
+class CalibrationLibrary(object):
+
+    """
+    Master calibration frames of all nights, stored in the ``MasterCal``
+    table and looked up in memory.
+    All masters are read from the database once, into an index by image
+    type, binning and, for darks, exposure time, with each group sorted by
+    observation date. `best` then finds the master to use for a frame
+    without querying the database, so nights without their own darks or
+    flats can be reduced with the masters of nearby nights.
+    Parameters
+    ----------
+    session : sqlalchemy.orm.Session
+        Session bound to a database with the tables of `models`.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self._groups = {}
+        self._dark_exptimes = {}
+        self._by_path = {}
+        for row in session.query(models.MasterCal):
+            if row.observation_date is None:
+                continue
+            self._index(self._entry(row))
+
+    @staticmethod
+    def _entry(row):
+        return LibraryMaster(row.id, row.path,
+                             calibration_imagetype(row.imagetype),
+                             row.observation_date, row.exptime, row.ccdtemp,
+                             row.xbinning or 1, row.ybinning or 1)
+
+    def _index(self, master):
+        exptime = master.exptime if master.imagetype == 'dark' else None
+        key = (master.imagetype, master.xbinning, master.ybinning, exptime)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _MasterGroup()
+            if exptime is not None:
+                exptimes = self._dark_exptimes.setdefault(key[:3], [])
+                bisect.insort(exptimes, exptime)
+        group.add(master)
+        self._by_path[master.path] = master
+
+    def __len__(self):
+        return sum(len(group.masters) for group in self._groups.values())
+
+    def add(self, path, imagetype, observation_date, exptime=None,
+            ccdtemp=None, xbinning=1, ybinning=1, calfiles=None):
+        """
+        Record a master in the database and in the index.
+        Parameters
+        ----------
+        path : str
+            Path of the master FITS file.
+        imagetype : str
+            Image type of the master, e.g. ``'bias'``, ``'dark'``, ``'flat'``.
+        observation_date : datetime.datetime
+            Date of the frames combined into the master.
+        exptime, ccdtemp : float, optional
+            Exposure time and CCD temperature of those frames.
+        xbinning, ybinning : int, optional
+        calfiles : list of (str, float), optional
+            Paths and exposure times of the frames combined into the master;
+            they are linked to the master through ``Combination``, reusing
+            the ``CalFile`` row of a path already recorded (e.g. by
+            `ingest.ingest_frames`) and adding one otherwise.
+        Returns
+        -------
+        LibraryMaster
+            The new entry, or the existing one if a master with the same path
+            is already in the library (e.g. when a night is reduced again).
+        """
+        if path in self._by_path:
+            return self._by_path[path]
+        now = datetime.datetime.now()
+        imagetype = calibration_imagetype(imagetype)
+        row = models.MasterCal(path=path, imagetype=imagetype,
+                               observation_date=observation_date,
+                               exptime=exptime, ccdtemp=ccdtemp,
+                               xbinning=xbinning, ybinning=ybinning,
+                               created_at=now, modified_at=now)
+        self._session.add(row)
+        for calfile_path, calfile_exptime in calfiles or []:
+            calfile = (self._session.query(models.CalFile)
+                       .filter_by(path=calfile_path)
+                       .order_by(models.CalFile.id).first())
+            if calfile is None:
+                calfile = models.CalFile(
+                    path=calfile_path, observation_date=observation_date,
+                    exptime=int(round(calfile_exptime)), created_at=now,
+                    imagetype=imagetype)
+            self._session.add(models.Combination(calfile=calfile,
+                                                 mastercal=row))
+        self._session.commit()
+        master = self._entry(row)
+        self._index(master)
+        return master
+
+    def best(self, imagetype, observation_date, exptime=None, xbinning=1,
+             ybinning=1, ccdtemp=None, max_age=None, max_temp_diff=None):
+        """
+        Master to use for a frame.
+        Masters must have the same image type and binning. For darks, the
+        closest exposure time to ``exptime`` is preferred; among masters with
+        that exposure time, the one closest in time wins.
+        Parameters
+        ----------
+        imagetype : str
+            Image type of the master wanted.
+        observation_date : datetime.datetime
+            Date of the frame to calibrate.
+        exptime : float, optional
+            Exposure time of the frame; used for darks only.
+        xbinning, ybinning : int, optional
+        ccdtemp : float, optional
+            CCD temperature of the frame.
+        max_age : datetime.timedelta, optional
+            Ignore masters further than this from ``observation_date``.
+        max_temp_diff : float, optional
+            Ignore masters whose CCD temperature differs from ``ccdtemp`` by
+            more than this.
+        Returns
+        -------
+        LibraryMaster or None
+            ``None`` if no master matches.
+        """
+        imagetype = calibration_imagetype(imagetype)
+        time = _timestamp(observation_date)
+        if max_age is not None:
+            max_age = max_age.total_seconds()
+        base_key = (imagetype, xbinning, ybinning)
+
+        if imagetype != 'dark':
+            exptimes = [None]
+        elif exptime is None:
+            exptimes = self._dark_exptimes.get(base_key, [])
+        else:
+            # dark exposure times in order of distance to the one wanted;
+            # there are only a handful of them
+            exptimes = sorted(self._dark_exptimes.get(base_key, []),
+                              key=lambda exp: abs(exp - exptime))
+
+        for anexp in exptimes:
+            group = self._groups.get(base_key + (anexp,))
+            if group is None:
+                continue
+            master = group.closest(time, max_age=max_age, ccdtemp=ccdtemp,
+                                   max_temp_diff=max_temp_diff)
+            if master is not None:
+                return master
+        return None
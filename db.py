@@ -0,0 +1,175 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import logging
+import os
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import models
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Database', 'create_engine', 'engine_options', 'database_url',
+           'DEFAULT_URL', 'URL_ENVIRONMENT_VARIABLE', 'DEFAULT_POOL_SIZE',
+           'DEFAULT_MAX_OVERFLOW', 'DEFAULT_BUSY_TIMEOUT']
+
+#: Database used when no URL is given and `URL_ENVIRONMENT_VARIABLE` is not
+#: set.
+DEFAULT_URL = 'sqlite:///toritos-dev.db'
+
+#: Environment variable holding the database URL, e.g.
+#: ``postgresql://toritos@localhost/toritos``.
+URL_ENVIRONMENT_VARIABLE = 'TORITOS_DB'
+
+#: Connections kept open by the pool of an engine, and how many more it may
+#: open when they are all in use.
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+
+#: Seconds a SQLite connection waits for a lock held by another connection
+#: before giving up with "database is locked".
+DEFAULT_BUSY_TIMEOUT = 60.
+
+
+def database_url(url=None):
+    """
+    ``url`` if given, otherwise the URL in the `URL_ENVIRONMENT_VARIABLE`
+    environment variable, otherwise `DEFAULT_URL`.
+    """
+    if url:
+        return url
+    return os.environ.get(URL_ENVIRONMENT_VARIABLE) or DEFAULT_URL
+
+
+def engine_options(url, pool_size=DEFAULT_POOL_SIZE,
+                   max_overflow=DEFAULT_MAX_OVERFLOW,
+                   busy_timeout=DEFAULT_BUSY_TIMEOUT):
+    """
+    Keyword arguments of `sqlalchemy.create_engine` for a database URL.
+    SQLite files get a busy timeout, so that concurrent writers wait for
+    each other instead of failing. In-memory SQLite databases keep the
+    pool SQLAlchemy picks for them, as each connection would see a
+    different database. Servers such as PostgreSQL get a pool of
+    ``pool_size`` connections, checked before use so connections the
+    server dropped are replaced.
+    Parameters
+    ----------
+    url : str or sqlalchemy.engine.URL
+    pool_size, max_overflow : int, optional
+    busy_timeout : float, optional
+        Seconds to wait for SQLite locks.
+    Returns
+    -------
+    dict
+    """
+    url = sa.engine.make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return {}
+        return {'pool_size': pool_size, 'max_overflow': max_overflow,
+                'connect_args': {'timeout': busy_timeout}}
+    return {'pool_size': pool_size, 'max_overflow': max_overflow,
+            'pool_pre_ping': True}
+
+
+def _configure_sqlite(engine, busy_timeout):
+    """
+    Switch a SQLite file database to write-ahead logging on every new
+    connection, so readers don't block the writer nor each other.
+    """
+    @sa.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        # safe with WAL: a power loss may only drop the last commits
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % int(busy_timeout * 1000))
+        cursor.close()
+
+
+def create_engine(url=None, echo=False, pool_size=DEFAULT_POOL_SIZE,
+                  max_overflow=DEFAULT_MAX_OVERFLOW,
+                  busy_timeout=DEFAULT_BUSY_TIMEOUT):
+    """
+    Engine for the pipeline database.
+    Parameters
+    ----------
+    url : str, optional
+        Database URL; see `database_url`.
+    echo : bool, optional
+        Log every SQL statement, for debugging.
+    pool_size, max_overflow, busy_timeout : optional
+        See `engine_options`.
+    Returns
+    -------
+    sqlalchemy.engine.Engine
+    """
+    url = sa.engine.make_url(database_url(url))
+    engine = sa.create_engine(url, echo=echo, **engine_options(
+        url, pool_size=pool_size, max_overflow=max_overflow,
+        busy_timeout=busy_timeout))
+    if url.get_backend_name() == 'sqlite' and \
+            url.database not in (None, '', ':memory:'):
+        _configure_sqlite(engine, busy_timeout)
+    logger.debug('Using database %s', url.render_as_string(hide_password=True))
+    return engine
+
+
+class Database(object):
+
+    """
+    Engine and sessions of the pipeline database.
+    `Session` is a scoped session: every thread gets its own session, so
+    threads of a worker can use the database at the same time. Worker
+    processes started with `multiprocessing` must call `after_fork` before
+    using a `Database` created by their parent, so that they open their own
+    connections instead of sharing the parent's.
+    Parameters
+    ----------
+    url : str, optional
+        Database URL; see `database_url`.
+    create_tables : bool, optional
+        Create the tables of `models` that don't exist yet.
+    **kwargs
+        Passed to `create_engine`.
+    """
+
+    def __init__(self, url=None, create_tables=False, **kwargs):
+        self.engine = create_engine(url, **kwargs)
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
+        if create_tables:
+            models.Model.metadata.create_all(self.engine)
+
+    @contextmanager
+    def session(self):
+        """
+        Session of the current thread as a context manager: committed if the
+        block succeeds, rolled back if it raises, and closed afterwards.
+        """
+        session = self.Session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            self.Session.remove()
+
+    def after_fork(self):
+        """
+        Forget the connections inherited from the parent process, without
+        closing them under the parent's feet.
+        """
+        self.Session.registry.clear()
+        self.engine.dispose(close=False)
+
+    def dispose(self):
+        """
+        Close the sessions of this thread and all pooled connections.
+        """
+        self.Session.remove()
+        self.engine.dispose()
@@ -0,0 +1,145 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import re
+
+__all__ = ['read_header_entries', 'AmbiguousHeaderError']
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+_INT_RE = re.compile(r'^[+-]?\d+$')
+_FLOAT_RE = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([EeDd][+-]?\d+)?$')
+_KEYWORD_RE = re.compile(r'^[A-Z0-9_-]*$')
+
+
+class AmbiguousHeaderError(ValueError):
+    """
+    Raised when a header contains cards the fast parser does not handle.
+    Callers should fall back to `astropy.io.fits` for that file.
+    """
+
+
+def _parse_string(field):
+    """
+    Parse a FITS string value starting at the opening quote of ``field``.
+    Returns the value and the rest of the field after the closing quote.
+    """
+    chars = []
+    idx = 1
+    while idx < len(field):
+        if field[idx] == "'":
+            if field[idx + 1:idx + 2] == "'":
+                chars.append("'")
+                idx += 2
+                continue
+            return ''.join(chars).rstrip(), field[idx + 1:]
+        chars.append(field[idx])
+        idx += 1
+    raise AmbiguousHeaderError('unterminated string value')
+
+
+def _parse_value(field):
+    """
+    Parse the value field (columns 11-80) of a card.
+    """
+    stripped = field.lstrip()
+    if stripped.startswith("'"):
+        value, rest = _parse_string(stripped)
+        rest = rest.strip()
+        if rest and not rest.startswith('/'):
+            raise AmbiguousHeaderError('unexpected text after string')
+        return value
+
+    value = stripped.split('/', 1)[0].strip()
+    if value == 'T':
+        return True
+    if value == 'F':
+        return False
+    if _INT_RE.match(value):
+        return int(value)
+    if _FLOAT_RE.match(value):
+        return float(value.replace('D', 'E').replace('d', 'e'))
+    # Undefined, complex and malformed values are left to astropy.
+    raise AmbiguousHeaderError('cannot parse value %r' % value)
+
+
+def read_header_entries(file_name, keywords=None):
+    """
+    Read ``(keyword, value)`` pairs from the primary header of a FITS file
+    without building an `astropy.io.fits.Header`.
+    Only the 2880-byte header blocks of the primary HDU are read, and the
+    80-character cards are parsed directly. The entries have the same form
+    as those of ``ImageFileCollection._header_entries``: keywords are lower
+    case and ``comment``/``history`` cards are joined into one entry each at
+    the end of the list.
+    Parameters
+    ----------
+    file_name : str
+        Path to an uncompressed FITS file.
+    keywords : set of str, optional
+        Lower case keywords to extract. If ``None``, all keywords are
+        returned.
+    Returns
+    -------
+    list of (str, object)
+    Raises
+    ------
+    AmbiguousHeaderError
+        If the file is not a plain FITS file or contains cards that are not
+        handled here (``CONTINUE`` long strings, ``HIERARCH``, undefined or
+        complex values, ...). The header should be read with astropy
+        instead.
+    """
+    entries = []
+    multi_entry_keys = {'comment': [],
+                        'history': []}
+    first_card = True
+
+    with open(file_name, 'rb') as fits_file:
+        while True:
+            block = fits_file.read(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE:
+                raise AmbiguousHeaderError('no END card found')
+            try:
+                block = block.decode('ascii')
+            except UnicodeDecodeError:
+                raise AmbiguousHeaderError('header is not ASCII')
+
+            for start in range(0, BLOCK_SIZE, CARD_SIZE):
+                card = block[start:start + CARD_SIZE]
+                keyword = card[:8].rstrip()
+
+                if first_card:
+                    if keyword != 'SIMPLE':
+                        raise AmbiguousHeaderError('no SIMPLE card found')
+                    first_card = False
+
+                if keyword == 'END':
+                    for k in ['comment', 'history']:
+                        if multi_entry_keys[k]:
+                            entries.append(
+                                (k, ','.join(multi_entry_keys[k])))
+                    return entries
+
+                if not _KEYWORD_RE.match(keyword) or keyword in ['CONTINUE',
+                                                                 'HIERARCH',
+                                                                 'FILE']:
+                    raise AmbiguousHeaderError('cannot parse card %r' % card)
+
+                if keyword == '':
+                    continue
+
+                lower = keyword.lower()
+                if lower in ['comment', 'history']:
+                    if keywords is None or lower in keywords:
+                        multi_entry_keys[lower].append(card[8:].rstrip())
+                    continue
+
+                if keywords is not None and lower not in keywords:
+                    continue
+
+                if card[8:10] != '= ':
+                    raise AmbiguousHeaderError('cannot parse card %r' % card)
+
+                entries.append((lower, _parse_value(card[10:])))
@@ -0,0 +1,154 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import logging
+
+import numpy as np
+
+import astropy.io.fits as fits
+import ccdproc
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Frame']
+
+# Data type of the values stored in a FITS image, by BITPIX.
+_STORED_DTYPE = {8: np.dtype('uint8'), 16: np.dtype('>i2'),
+                 32: np.dtype('>i4'), 64: np.dtype('>i8'),
+                 -32: np.dtype('>f4'), -64: np.dtype('>f8')}
+
+# Unsigned (and, for BITPIX 8, signed) integers stored with the BZERO
+# convention of the FITS standard.
+_PSEUDO_INTEGER = {(8, -128): np.dtype('int8'),
+                   (16, 1 << 15): np.dtype('uint16'),
+                   (32, 1 << 31): np.dtype('uint32'),
+                   (64, 1 << 63): np.dtype('uint64')}
+
+
+class Frame(object):
+
+    """
+    Read-only, memory-mapped access to a FITS image.
+    The image is mapped with `numpy.memmap` instead of being read, so
+    indexing a frame, e.g. ``frame[rows]`` for a band of rows, only reads
+    the pages of the file holding those pixels; reading the same frames
+    again, in another pass or another process, is served from the page
+    cache.
+    Images without ``BZERO``, ``BSCALE`` or ``BLANK`` are returned as
+    read-only views of the file, without any copy. Otherwise the indexed
+    pixels are scaled as `astropy.io.fits` does (e.g. raw unsigned 16-bit
+    frames become ``uint16``), giving the same values as ``hdu.section``.
+    Compressed files can't be mapped; they are read through
+    ``hdu.section`` instead.
+    Parameters
+    ----------
+    file_name : str
+        Path of the FITS file.
+    ext : int or str, optional
+        HDU of the image. Default is the primary HDU.
+    """
+
+    def __init__(self, file_name, ext=0):
+        self.file_name = file_name
+        self._hdulist = None
+        self.raw = None
+        hdulist = fits.open(file_name, memmap=False, lazy_load_hdus=True)
+        try:
+            hdu = hdulist[ext]
+            self.header = hdu.header
+            self.shape = hdu.shape
+            fileinfo = hdulist.fileinfo(hdulist.index_of(ext))
+            compressed = (isinstance(hdu, fits.CompImageHDU) or
+                          getattr(fileinfo['file'], 'compression', None))
+            if compressed:
+                logger.debug('%s is compressed, reading it by sections',
+                             file_name)
+                self._hdulist = hdulist
+                self._hdu = hdu
+                self.dtype = hdu.section.dtype
+                return
+            bitpix = self.header['BITPIX']
+            self.raw = np.memmap(file_name, dtype=_STORED_DTYPE[bitpix],
+                                 mode='r', offset=fileinfo['datLoc'],
+                                 shape=self.shape)
+        finally:
+            if self._hdulist is None:
+                hdulist.close()
+
+        self._bzero = self.header.get('BZERO', 0)
+        self._bscale = self.header.get('BSCALE', 1)
+        blank = self.header.get('BLANK')
+        self._blank = blank if bitpix > 0 and isinstance(blank, int) \
+            else None
+        self._pseudo_integer = None
+        if self._bscale == 1:
+            self._pseudo_integer = _PSEUDO_INTEGER.get((bitpix, self._bzero))
+        if not self.scaled:
+            self.dtype = self.raw.dtype
+        elif self._pseudo_integer is not None:
+            self.dtype = self._pseudo_integer
+        else:
+            self.dtype = np.dtype('float64' if bitpix > 16 else 'float32')
+
+    @property
+    def scaled(self):
+        """
+        ``True`` if the stored values are scaled, so indexing returns copies
+        instead of views of the file.
+        """
+        if self.raw is None:
+            return True
+        return not (self._bzero == 0 and self._bscale == 1 and
+                    self._blank is None)
+
+    @property
+    def data(self):
+        """
+        The whole image; read-only unless it had to be scaled.
+        """
+        return self[...]
+
+    def __getitem__(self, key):
+        if self.raw is None:
+            if self._hdulist is None:
+                raise ValueError('Frame {} is closed'.format(self.file_name))
+            return self._hdu.section[key]
+        raw = self.raw[key]
+        if not self.scaled:
+            return raw
+        if self._pseudo_integer is not None and \
+                self._pseudo_integer.kind == 'u':
+            data = np.array(raw, dtype=self.dtype)
+            data -= self.dtype.type(self._bzero)
+            return data
+        data = np.array(raw, dtype=self.dtype)
+        if self._bscale != 1:
+            np.multiply(data, self._bscale, data)
+        if self._bzero != 0:
+            data += self._bzero
+        if self._blank and self.dtype.kind == 'f':
+            data[raw == self._blank] = np.nan
+        return data
+
+    def ccd(self, key=Ellipsis, unit='adu'):
+        """
+        A section of the image as a `ccdproc.CCDData`, with the header of
+        the frame as meta.
+        """
+        return ccdproc.CCDData(self[key], unit=unit, meta=self.header)
+
+    def close(self):
+        """
+        Release the mapping (or the file of a compressed frame). Views
+        returned before stay valid.
+        """
+        self.raw = None
+        if self._hdulist is not None:
+            self._hdulist.close()
+            self._hdulist = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
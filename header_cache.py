@@ -0,0 +1,130 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import json
+import logging
+import sqlite3
+from os import path
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['HeaderCache', 'HEADER_CACHE_NAME']
+
+#: Name of the sidecar file written next to the FITS files of a collection.
+HEADER_CACHE_NAME = '.header_cache.sqlite'
+
+
+class HeaderCache(object):
+
+    """
+    Persistent on-disk index of FITS header entries.
+    Entries are stored in a SQLite sidecar file and keyed by the path of the
+    file relative to the collection location, its size and modification
+    time, so a file whose size or mtime changed is read again while
+    untouched files are served from the cache.
+    Parameters
+    ----------
+    cache_path : str
+        Path to the SQLite file. If it is a directory, the default
+        ``HEADER_CACHE_NAME`` inside that directory is used.
+    """
+
+    def __init__(self, cache_path):
+        if path.isdir(cache_path):
+            cache_path = path.join(cache_path, HEADER_CACHE_NAME)
+        self._path = cache_path
+        self._pending = []
+        self._conn = sqlite3.connect(cache_path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS headers ('
+                           'file TEXT PRIMARY KEY, size INTEGER, '
+                           'mtime REAL, entries TEXT)')
+        # Load everything at once; a night directory holds a few thousand
+        # rows at most and one query is much cheaper than one per file.
+        self._known = {}
+        for file_name, size, mtime, entries in self._conn.execute(
+                'SELECT file, size, mtime, entries FROM headers'):
+            self._known[file_name] = (size, mtime, entries)
+
+    @property
+    def path(self):
+        """
+        str, Path to the SQLite sidecar file.
+        """
+        return self._path
+
+    def get(self, file_name, size, mtime):
+        """
+        Cached header entries for a file.
+        Parameters
+        ----------
+        file_name : str
+            Path of the file relative to the collection location, e.g.
+            ``'light0.fit'`` or ``'20150916/light0.fit'`` in a recursive
+            collection.
+        size, mtime : int, float
+            Current size and modification time of the file, as returned by
+            ``os.stat``.
+        Returns
+        -------
+        list of (str, object) or None
+            The cached ``(keyword, value)`` pairs, or ``None`` if the file is
+            not in the cache or has changed since it was cached.
+        """
+        try:
+            cached_size, cached_mtime, entries = self._known[file_name]
+        except KeyError:
+            return None
+        if cached_size != size or cached_mtime != mtime:
+            return None
+        return [tuple(entry) for entry in json.loads(entries)]
+
+    def put(self, file_name, size, mtime, entries):
+        """
+        Queue header entries for a file; they are written on ``flush``.
+        Files whose values cannot be stored as JSON (e.g. undefined or
+        complex header values) are not cached and will simply be read again
+        on the next scan.
+        Parameters
+        ----------
+        file_name : str
+            Path of the file relative to the collection location; see `get`.
+        size, mtime : int, float
+            Size and modification time of the file, as returned by
+            ``os.stat``.
+        entries : list of (str, object)
+            ``(keyword, value)`` pairs of the header.
+        """
+        try:
+            encoded = json.dumps(entries)
+        except (TypeError, ValueError):
+            logger.debug('Not caching header of %s, values are not '
+                         'serializable', file_name)
+            return
+        self._known[file_name] = (size, mtime, encoded)
+        self._pending.append((file_name, size, mtime, encoded))
+
+    def flush(self, keep=None):
+        """
+        Write queued entries to disk in a single transaction.
+        Parameters
+        ----------
+        keep : list of str, optional
+            Paths relative to the collection location of the files to keep;
+            if given, rows for other files are removed so the cache does not
+            grow with files deleted from the collection.
+        """
+        with self._conn:
+            if self._pending:
+                self._conn.executemany('INSERT OR REPLACE INTO headers '
+                                       '(file, size, mtime, entries) '
+                                       'VALUES (?, ?, ?, ?)', self._pending)
+            if keep is not None:
+                stale = set(self._known) - set(keep)
+                self._conn.executemany('DELETE FROM headers WHERE file = ?',
+                                       [(file_name,) for file_name in stale])
+                for file_name in stale:
+                    del self._known[file_name]
+        self._pending = []
+
+    def close(self):
+        self._conn.close()
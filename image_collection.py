@@ -2,9 +2,16 @@
 from __future__ import (print_function, division, absolute_import,
                         unicode_literals)
 
-import fnmatch
-from os import listdir, path
+from os import path, stat
 import logging
+import sqlite3
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2 needs the scandir backport from PyPI.
+    from scandir import scandir
 
 import numpy as np
 import numpy.ma as ma
@@ -13,12 +20,52 @@ from astropy.table import Table, vstack
 import astropy.io.fits as fits
 from astropy.extern import six
 
+from fits_header import read_header_entries, AmbiguousHeaderError
+from frames import Frame
+from header_cache import HeaderCache
+
 logger = logging.getLogger(__name__)
 
 __all__ = ['ImageFileCollection']
 __doctest_skip__ = ['*']
 
 
+class _ColumnIndex(object):
+
+    """
+    Case-folded lookup table for the string values of one summary column.
+    Maps each lower case value to the indices of the rows that have it, so
+    a case insensitive equality filter is a dictionary lookup rather than a
+    Python loop over every row.
+    Parameters
+    ----------
+    column : astropy.table.MaskedColumn
+        Column to index. Masked and non-string values are not indexed.
+    """
+
+    def __init__(self, column):
+        self._length = len(column)
+        missing = ma.getmaskarray(column)
+        rows = {}
+        for idx, value in enumerate(column.data):
+            if missing[idx] or not isinstance(value, six.string_types):
+                continue
+            rows.setdefault(value.lower(), []).append(idx)
+        self._rows = dict((k, np.array(v, dtype=int))
+                          for k, v in six.iteritems(rows))
+
+    def matches(self, value):
+        """
+        Boolean array, True for the rows whose value equals ``value``
+        ignoring case.
+        """
+        have_this_value = np.zeros(self._length, dtype=bool)
+        idx = self._rows.get(value.lower())
+        if idx is not None:
+            have_this_value[idx] = True
+        return have_this_value
+
+
 class ImageFileCollection(object):
 
     """
@@ -42,6 +89,24 @@ class ImageFileCollection(object):
         In this case the keywords are set to the names of the columns of the
         ``info_file`` unless ``keywords`` is explicitly set to a different
         list.
+    use_cache : bool, optional
+        If ``True``, header values are kept in a sidecar file in ``location``
+        (see `header_cache.HeaderCache`) and only new or modified files are
+        opened when the summary is built. Default is ``False``.
+    workers : int, optional
+        Number of threads used to read FITS headers. Reading is bound by
+        file system latency, so on network storage several workers scan a
+        directory considerably faster. Default is ``1`` (no threads).
+    fast_headers : bool, optional
+        If ``True``, headers are parsed directly from the raw header blocks
+        (see `fits_header.read_header_entries`) instead of building an
+        `astropy.io.fits.Header` for each file; only the requested keywords
+        are extracted. Files the fast parser cannot handle are read with
+        astropy. Default is ``False``.
+    recursive : bool, optional
+        If ``True``, FITS files in all subdirectories of ``location`` are
+        included; their ``file`` entries are paths relative to
+        ``location``. Default is ``False``.
     Raises
     ------
     ValueError
@@ -49,11 +114,23 @@ class ImageFileCollection(object):
         value.
     """
 
-    def __init__(self, location=None, keywords=None, info_file=None):
+    def __init__(self, location=None, keywords=None, info_file=None,
+                 use_cache=False, workers=1, fast_headers=False,
+                 recursive=False):
         self._location = location
+        self._use_cache = use_cache
+        self._workers = workers
+        self._fast_headers = fast_headers
+        self._recursive = recursive
+        # Lazily built _ColumnIndex for each column of _indexed_summary;
+        # discarded whenever the summary table is replaced.
+        self._column_indexes = {}
+        self._indexed_summary = None
         self._files = []
         if location:
-            self._files = self._fits_files_in_directory()
+            # Discovered lazily: the first header scan consumes the
+            # directory listing as it is produced.
+            self._files = None
         self._summary_info = {}
         if keywords is None:
             if info_file is not None:
@@ -174,6 +251,8 @@ class ImageFileCollection(object):
         """
         list of str, Unfiltered list of FITS files in location.
         """
+        if self._files is None:
+            self._files = self._fits_files_in_directory()
         return self._files
 
     def values(self, keyword, unique=False):
@@ -211,66 +290,88 @@ class ImageFileCollection(object):
         >>> collection.files_filtered(imagetyp='*', filter='')
         NOTE: Value comparison is case *insensitive* for strings.
         """
-        # force a copy by explicitly converting to a list
-        current_file_mask = list(self.summary_info['file'].mask)
-        self._find_keywords_by_values(**kwd)
-        filtered_files = self.summary_info['file'].compressed()
-        self.summary_info['file'].mask = current_file_mask
-        return filtered_files
+        matches = self._find_keywords_by_values(**kwd)
+        return np.asarray(self.summary_info['file'])[matches]
+
+    def rows_filtered(self, **kwd):
+        """Determine rows of the summary whose keywords have listed values.
+        Takes the same keyword/value filters as ``files_filtered``. The
+        summary table is not modified, so a collection can be queried from
+        several threads at once.
+        Example:
+        >>> rows = collection.rows_filtered(imagetyp='LIGHT')
+        >>> for header in collection.headers(rows=rows):
+        ...     print(header['object'])
+        Returns
+        -------
+        numpy.ndarray
+            Read-only array of row indices into ``summary``; pass it as
+            ``rows`` to ``headers``, ``hdus`` or ``data``.
+        """
+        rows = np.flatnonzero(self._find_keywords_by_values(**kwd))
+        rows.flags.writeable = False
+        return rows
 
-    def refresh(self):
+    def refresh(self, workers=None):
         """
         Refresh the collection by re-reading headers.
+        Parameters
+        ----------
+        workers : int, optional
+            Number of threads used to read FITS headers. If not given, the
+            value the collection was created with is used.
         """
+        if workers is not None:
+            self._workers = workers
         keywords = '*' if self._all_keywords else self.keywords
-        # Re-load list of files
-        self._files = self._fits_files_in_directory()
+        # Re-load list of files while reading the headers
+        self._files = None
         self._summary_info = self._fits_summary(header_keywords=keywords)
+        self._column_indexes = {}
 
-    def _dict_from_fits_header(self, file_name, input_summary=None,
-                               missing_marker=None):
+    def _header_entries(self, file_name, header_cache=None, keywords=None):
         """
-        Construct a dictionary whose keys are the header keywords and values
-        are a list of the values from this file and the input dictionary.
+        List of ``(keyword, value)`` pairs from the primary header of a file.
+        Keywords are lower case; ``comment`` and ``history`` cards are joined
+        into a single comma-separated entry each, at the end of the list.
         Parameters
         ----------
         file_name : str
             Name of FITS file.
-        input_summary : dict
-            Existing dictionary to which new values should be appended.
-        Returns
-        -------
-        file_table : astropy.table.Table
+        header_cache : header_cache.HeaderCache, optional
+            If given, entries are taken from the cache when the file has not
+            changed, and stored in it after the header is read otherwise.
+        keywords : set of str, optional
+            Lower case keywords needed by the caller. Only used by the fast
+            parser, which then skips all other cards; astropy always reads
+            the full header.
         """
-        from astropy.utils.compat.odict import OrderedDict
-
-        def _add_val_to_dict(key, value, tbl_dict, n_prev):
+        if header_cache is not None:
+            file_stat = stat(file_name)
+            base_name = path.relpath(file_name, self.location)
+            entries = header_cache.get(base_name, file_stat.st_size,
+                                       file_stat.st_mtime)
+            if entries is not None:
+                return entries
+
+        if self._fast_headers and not file_name.endswith('.gz'):
             try:
-                tbl_dict[key.lower()].append(value)
-            except KeyError:
-                tbl_dict[key.lower()] = [missing_marker] * n_previous
-                tbl_dict[key.lower()].append(value)
-
-        if input_summary is None:
-            summary = OrderedDict()
-            n_previous = 0
-        else:
-            summary = input_summary
-            n_previous = len(summary['file'])
+                entries = read_header_entries(file_name, keywords=keywords)
+            except AmbiguousHeaderError as e:
+                logger.debug('Falling back to astropy for %s: %s',
+                             file_name, e)
+            else:
+                # Partial entries would poison the cache for later scans
+                # that ask for other keywords.
+                if header_cache is not None and keywords is None:
+                    header_cache.put(base_name, file_stat.st_size,
+                                     file_stat.st_mtime, entries)
+                return entries
 
         h = fits.getheader(file_name)
         assert 'file' not in h
 
-        # Try opening header before this so that file name is only added if
-        # file is valid FITS
-        try:
-            summary['file'].append(path.basename(file_name))
-        except KeyError:
-            summary['file'] = [path.basename(file_name)]
-
-        missing_in_this_file = [k for k in summary if (k not in h and
-                                                       k != 'file')]
-
+        entries = []
         multi_entry_keys = {'comment': [],
                             'history': []}
 
@@ -283,20 +384,84 @@ class ImageFileCollection(object):
                 # Accumulate these in a separate dictionary until the
                 # end to avoid adding multiple entries to summary.
                 continue
-            else:
-                val = v
 
-            _add_val_to_dict(k, val, summary, n_previous)
+            entries.append((k.lower(), v))
 
         for k, v in six.iteritems(multi_entry_keys):
             if v:
-                joined = ','.join(v)
-                _add_val_to_dict(k, joined, summary, n_previous)
+                entries.append((k, ','.join(v)))
+
+        if header_cache is not None:
+            header_cache.put(base_name, file_stat.st_size,
+                             file_stat.st_mtime, entries)
+
+        return entries
+
+    def _open_header_cache(self):
+        """
+        Open the header cache of ``location``, or return ``None`` if caching
+        is disabled or the sidecar file cannot be used.
+        """
+        if not (self._use_cache and self.location):
+            return None
+        try:
+            return HeaderCache(self.location)
+        except sqlite3.Error as e:
+            logger.warning('Unable to use header cache in %s: %s',
+                           self.location, e)
+            return None
+
+    def _summary_from_entries(self, all_entries):
+        """
+        Build the summary table columns from the header entries of each file.
+        Columns are allocated once and filled in a single pass over the
+        entries, so the cost is linear in the number of files times the
+        number of keywords.
+        Parameters
+        ----------
+        all_entries : list of (str, list)
+            For each file, in summary order, its name and its entries as
+            returned by ``_header_entries``. Files whose entries are ``None``
+            could not be read and are left out of the summary.
+        Returns
+        -------
+        summary_table : astropy.table.Table
+        """
+        from astropy.table import MaskedColumn
+        from astropy.utils.compat.odict import OrderedDict
 
-        for missing in missing_in_this_file:
-            summary[missing].append(missing_marker)
+        rows = [(file_name, entries) for file_name, entries in all_entries
+                if entries is not None]
+        if not rows:
+            return Table(masked=True)
 
-        return summary
+        n_rows = len(rows)
+        # Column order is the order in which keywords first appear.
+        values = OrderedDict()
+        values['file'] = np.empty(n_rows, dtype=object)
+        present = {'file': np.ones(n_rows, dtype=bool)}
+
+        for idx, (file_name, entries) in enumerate(rows):
+            values['file'][idx] = file_name
+            for k, v in entries:
+                try:
+                    values[k][idx] = v
+                except KeyError:
+                    values[k] = np.empty(n_rows, dtype=object)
+                    present[k] = np.zeros(n_rows, dtype=bool)
+                    values[k][idx] = v
+                present[k][idx] = True
+
+        columns = []
+        for k, column_values in six.iteritems(values):
+            mask = ~present[k]
+            if not mask.any():
+                # Let numpy pick the type, as it would for a plain list.
+                column_values = np.array(column_values.tolist())
+            columns.append(MaskedColumn(name=k, data=column_values,
+                                        mask=mask))
+
+        return Table(columns, masked=True)
 
     def _set_column_name_case_to_match_keywords(self, header_keys,
                                                 summary_table):
@@ -327,39 +492,78 @@ class ImageFileCollection(object):
         """
         from astropy.table import MaskedColumn
 
-        if not self.files:
-            return None
+        if self._files is None:
+            # Record file names as they stream out of the directory scan.
+            discovered = []
+            file_names = self._discover_files(discovered)
+        else:
+            discovered = None
+            file_names = self.files
+            if not file_names:
+                return None
 
         # Get rid of any duplicate keywords, also forces a copy.
         header_keys = set(header_keywords)
         header_keys.add('file')
 
-        file_name_column = MaskedColumn(name='file', data=self.files)
-
         if not header_keys or (header_keys == set(['file'])):
+            file_names = list(file_names)
+            if discovered is not None:
+                self._files = discovered
+            if not file_names:
+                return None
+            file_name_column = MaskedColumn(name='file', data=file_names)
             summary_table = Table(masked=True)
             summary_table.add_column(file_name_column)
             return summary_table
 
-        summary_dict = None
-        missing_marker = None
+        header_cache = self._open_header_cache()
+        if '*' in header_keys:
+            wanted_keys = None
+        else:
+            wanted_keys = set(k.lower() for k in header_keys)
 
-        for file_name in file_name_column:
+        def _read_entries(file_name):
             file_path = path.join(self.location, file_name)
             try:
-                summary_dict = self._dict_from_fits_header(
-                    file_path, input_summary=summary_dict,
-                    missing_marker=missing_marker)
+                return file_name, self._header_entries(
+                    file_path, header_cache=header_cache,
+                    keywords=wanted_keys)
             except IOError as e:
                 logger.warning('Unable to get FITS header for file %s: %s',
                                file_path, e)
-                continue
+                return file_name, None
+
+        if self._workers > 1:
+            # imap keeps the order of the input, so the summary comes out
+            # the same as with a single worker, and it pulls file names
+            # from the directory scan while headers are being read.
+            pool = ThreadPool(self._workers)
+            try:
+                all_entries = list(pool.imap(_read_entries, file_names,
+                                             chunksize=16))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            all_entries = list(six.moves.map(_read_entries, file_names))
 
-        summary_table = Table(summary_dict, masked=True)
+        if discovered is not None:
+            self._files = discovered
+            if not discovered:
+                if header_cache is not None:
+                    header_cache.close()
+                return None
 
-        for column in summary_table.colnames:
-            summary_table[column].mask = [v is missing_marker
-                                          for v in summary_table[column]]
+        summary_table = self._summary_from_entries(all_entries)
+
+        if header_cache is not None:
+            try:
+                header_cache.flush(keep=self.files)
+            except sqlite3.Error as e:
+                logger.warning('Unable to update header cache %s: %s',
+                               header_cache.path, e)
+            header_cache.close()
 
         self._set_column_name_case_to_match_keywords(header_keys,
                                                      summary_table)
@@ -380,6 +584,20 @@ class ImageFileCollection(object):
 
         return summary_table
 
+    def _column_index(self, key):
+        """
+        `_ColumnIndex` for a column of the summary, built on first use.
+        """
+        if self._indexed_summary is not self._summary_info:
+            self._column_indexes = {}
+            self._indexed_summary = self._summary_info
+        try:
+            return self._column_indexes[key]
+        except KeyError:
+            index = _ColumnIndex(self._summary_info[key])
+            self._column_indexes[key] = index
+            return index
+
     def _find_keywords_by_values(self, **kwd):
         """
         Find files whose keywords have given values.
@@ -392,6 +610,10 @@ class ImageFileCollection(object):
         >>> collection.files_filtered(imagetyp='LIGHT', filter='R')
         >>> collection.files_filtered(imagetyp='*', filter='')
         NOTE: Value comparison is case *insensitive* for strings.
+        Returns
+        -------
+        numpy.ndarray
+            Boolean array, True for the rows of the summary that match.
         """
         keywords = kwd.keys()
         values = kwd.values()
@@ -399,33 +621,22 @@ class ImageFileCollection(object):
         if (set(keywords).issubset(set(self.keywords))):
             # we already have the information in memory
             use_info = self.summary_info
+            column_index = self._column_index
         else:
             # we need to load information about these keywords.
             use_info = self._fits_summary(header_keywords=keywords)
+            column_index = lambda key: _ColumnIndex(use_info[key])
 
-        matches = np.array([True] * len(use_info))
+        matches = np.ones(len(use_info), dtype=bool)
         for key, value in zip(keywords, values):
             logger.debug('Key %s, value %s', key, value)
-            logger.debug('Value in table %s', use_info[key])
-            value_missing = use_info[key].mask
-            logger.debug('Value missing: %s', value_missing)
+            value_missing = ma.getmaskarray(use_info[key])
             value_not_missing = np.logical_not(value_missing)
             if value == '*':
                 have_this_value = value_not_missing
             elif value is not None:
                 if isinstance(value, six.string_types):
-                    # need to loop explicitly over array rather than using
-                    # where to correctly do string comparison.
-                    have_this_value = np.array([False] * len(use_info))
-                    for idx, file_key_value in enumerate(use_info[key]):
-                        if value_not_missing[idx]:
-                            value_matches = (file_key_value.lower() ==
-                                             value.lower())
-                        else:
-                            value_matches = False
-
-                        have_this_value[idx] = (value_not_missing[idx] &
-                                                value_matches)
+                    have_this_value = column_index(key).matches(value)
                 else:
                     have_this_value = value_not_missing
                     tmp = (use_info[key][value_not_missing] == value)
@@ -438,11 +649,8 @@ class ImageFileCollection(object):
 
             matches &= have_this_value
 
-        # the numpy convention is that the mask is True for values to
-        # be omitted, hence use ~matches.
         logger.debug('Matches: %s', matches)
-        self.summary_info['file'].mask = ma.nomask
-        self.summary_info['file'][~matches] = ma.masked
+        return matches
 
     def _fits_files_in_directory(self, extensions=None,
                                  compressed=True):
@@ -461,17 +669,43 @@ class ImageFileCollection(object):
         list
             *Names* of the files (with extension), not the full pathname.
         """
-        full_extensions = extensions or ['fit', 'fits']
-        if compressed:
-            with_gz = [extension + '.gz' for extension in full_extensions]
-            full_extensions.extend(with_gz)
-
-        all_files = listdir(self.location)
-        files = []
-        for extension in full_extensions:
-            files.extend(fnmatch.filter(all_files, '*' + extension))
+        return list(self._iter_fits_files(extensions=extensions,
+                                          compressed=compressed))
 
-        return files
+    def _iter_fits_files(self, extensions=None, compressed=True):
+        """
+        Generator of the names of FITS files in location.
+        Each directory is read once with ``scandir`` and every entry is
+        matched against all extensions in the same pass. If the collection
+        is recursive, subdirectories are walked as well and names are
+        relative to location. Symbolic links to directories are not
+        followed.
+        Parameters are the same as for ``_fits_files_in_directory``.
+        """
+        full_extensions = list(extensions or ['fit', 'fits'])
+        if compressed:
+            full_extensions.extend([extension + '.gz'
+                                    for extension in full_extensions])
+        full_extensions = tuple(full_extensions)
+
+        pending = ['']
+        while pending:
+            relative_dir = pending.pop()
+            for entry in scandir(path.join(self.location, relative_dir)):
+                name = path.join(relative_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if self._recursive:
+                        pending.append(name)
+                elif entry.name.endswith(full_extensions):
+                    yield name
+
+    def _discover_files(self, discovered):
+        """
+        Yield the FITS files in location, appending each to ``discovered``.
+        """
+        for file_name in self._iter_fits_files():
+            discovered.append(file_name)
+            yield file_name
 
     def _generator(self, return_type,
                    save_with_name="", save_location='',
@@ -479,6 +713,8 @@ class ImageFileCollection(object):
                    overwrite=False,
                    do_not_scale_image_data=True,
                    return_fname=False,
+                   rows=None,
+                   memmap=None,
                    **kwd):
         """
         Generator that yields each {name} in the collection.
@@ -508,6 +744,12 @@ class ImageFileCollection(object):
         return_fname : bool, default is False
             If True, return the tuple (header, file_name) instead of just
             header.
+        rows : array of int, optional
+            Only iterate over these rows of the summary, e.g. as returned by
+            ``rows_filtered``. Combined with any filters in ``kwd``.
+        memmap : bool, optional
+            Passed to `astropy.io.fits.open`; by default astropy memory-maps
+            uncompressed files.
         kwd : dict
             Any additional keywords are used to filter the items returned; see
             Examples for details.
@@ -520,34 +762,26 @@ class ImageFileCollection(object):
             If ``return_fname`` is ``True``, yield a tuple of
             ({name}, ``file path``) for next the  item in the collection.
         """
-        # store mask so we can reset at end--must COPY, otherwise
-        # current_mask just points to the mask of summary_info
         if not self.summary_info:
             return
 
-        current_mask = {}
-        for col in self.summary_info.columns:
-            current_mask[col] = self.summary_info[col].mask
-
-        if kwd:
-            self._find_keywords_by_values(**kwd)
-
-        for full_path in self._paths():
+        for full_path in self._paths(self._selected_rows(rows, kwd)):
             no_scale = do_not_scale_image_data
             hdulist = fits.open(full_path,
-                                do_not_scale_image_data=no_scale)
-
-            return_options = {'header': hdulist[0].header,
-                              'hdu': hdulist[0],
-                              'data': hdulist[0].data}
+                                do_not_scale_image_data=no_scale,
+                                memmap=memmap)
 
+            # only read the image if it is asked for
+            return_options = {'header': lambda: hdulist[0].header,
+                              'hdu': lambda: hdulist[0],
+                              'data': lambda: hdulist[0].data}
             try:
-                yield (return_options[return_type]  # pragma: no branch
-                       if (not return_fname) else
-                       (return_options[return_type], full_path))
+                item = return_options[return_type]()
             except KeyError:
                 raise ValueError('No generator for {}'.format(return_type))
 
+            yield item if not return_fname else (item, full_path)
+
             if save_location:
                 destination_dir = save_location
             else:
@@ -571,15 +805,28 @@ class ImageFileCollection(object):
                     raise
             hdulist.close()
 
-        # reset mask
-        for col in self.summary_info.columns:
-            self.summary_info[col].mask = current_mask[col]
-
-    def _paths(self):
+    def _selected_rows(self, rows, kwd):
         """
-        Full path to each file.
+        Summary rows in ``rows`` (all by default) matching the filters in
+        ``kwd``.
         """
-        unmasked_files = self.summary_info['file'].compressed()
+        if not kwd:
+            return rows
+        matches = self._find_keywords_by_values(**kwd)
+        if rows is not None:
+            selected = np.zeros(len(matches), dtype=bool)
+            selected[rows] = True
+            matches &= selected
+        return np.flatnonzero(matches)
+
+    def _paths(self, rows=None):
+        """
+        Full path to each file, or to the files in the given summary rows.
+        """
+        if rows is None:
+            unmasked_files = self.summary_info['file'].compressed()
+        else:
+            unmasked_files = np.asarray(self.summary_info['file'])[rows]
         return [path.join(self.location, file_) for file_ in unmasked_files]
 
     def headers(self, do_not_scale_image_data=True, **kwd):
@@ -606,3 +853,37 @@ class ImageFileCollection(object):
                                              default_scaling='False',
                                              return_type='numpy.ndarray')
 
+    def frames(self, return_fname=False, rows=None, **kwd):
+        """
+        Generator that yields a read-only, memory-mapped `frames.Frame` of
+        each image in the collection.
+        Pixels are only read from disk when the frame is indexed, so a tile
+        of every frame of a night can be read without loading the frames.
+        Each frame is closed when the next one is requested; arrays taken
+        from it stay valid.
+        Parameters
+        ----------
+        return_fname : bool, default is False
+            If True, return the tuple (frame, file_name) instead of just
+            the frame.
+        rows : array of int, optional
+            Only iterate over these rows of the summary, e.g. as returned by
+            ``rows_filtered``. Combined with any filters in ``kwd``.
+        kwd : dict
+            Any additional keywords are used to filter the frames returned,
+            as for `headers`.
+        Returns
+        -------
+        frames.Frame
+            If ``return_fname`` is ``False``, yield the next frame.
+        (frames.Frame, str)
+            If ``return_fname`` is ``True``, yield a tuple of the frame and
+            its path.
+        """
+        if not self.summary_info:
+            return
+
+        for full_path in self._paths(self._selected_rows(rows, kwd)):
+            with Frame(full_path) as frame:
+                yield frame if not return_fname else (frame, full_path)
+
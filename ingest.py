@@ -0,0 +1,360 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import datetime
+import logging
+import time
+from collections import namedtuple
+from os import path
+
+import numpy as np
+import sqlalchemy as sa
+
+import models
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['ingest_frames', 'summary_rows', 'load_sources',
+           'load_candidates', 'get_state_id', 'LoadStats', 'DEFAULT_BATCH_SIZE',
+           'DEFAULT_CATALOG_BATCH_SIZE', 'INGEST_KEYWORDS']
+
+#: Number of frames written per transaction by `ingest_frames`.
+DEFAULT_BATCH_SIZE = 1000
+
+#: Header keywords used by `ingest_frames`; collect them when scanning.
+INGEST_KEYWORDS = ['imagetyp', 'exptime', 'date-obs', 'jd', 'ccd-temp',
+                   'xbinning', 'ybinning', 'object']
+
+#: Number of catalog rows written per executemany by `load_sources` and
+#: `load_candidates`.
+DEFAULT_CATALOG_BATCH_SIZE = 20000
+
+_CALIBRATION_TYPES = ['bias', 'zero', 'dark', 'flat']
+
+_CATALOG_COLUMNS = ['ra', 'dec', 'mag', 'mag_err']
+
+# Settings for bulk loads into SQLite: don't wait for the disk after every
+# transaction and keep temporary data and more pages in memory.
+# They are restored afterwards, as the connection goes back to the pool.
+_SQLITE_BULK_PRAGMAS = [('synchronous', 'OFF'),
+                        ('temp_store', 'MEMORY'),
+                        ('cache_size', '-65536')]
+
+#: Result of `load_sources` and `load_candidates`.
+LoadStats = namedtuple('LoadStats', ['rows', 'seconds', 'rows_per_second'])
+
+
+def summary_rows(collection, location=None):
+    """
+    Rows of the summary of an `ImageFileCollection` as dictionaries of
+    keyword to value, with masked values left out and ``'file'`` set to the
+    path of the file.
+    Parameters
+    ----------
+    collection : ImageFileCollection
+        Collection whose keywords include `INGEST_KEYWORDS`.
+    location : str, optional
+        Directory the file names are joined to; the location of the
+        collection by default.
+    """
+    if location is None:
+        location = collection.location
+    summary = collection.summary
+    names = [name for name in summary.colnames if name != 'file']
+    columns = [(name, summary[name]) for name in names]
+    for idx, file_name in enumerate(summary['file']):
+        row = {'file': path.join(location, file_name)}
+        for name, column in columns:
+            value = column[idx]
+            if value is np.ma.masked:
+                continue
+            row[name] = value.item() if hasattr(value, 'item') else value
+        yield row
+
+
+def _observation_date(row):
+    date = row.get('date-obs')
+    if not date:
+        return None
+    for fmt in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+        try:
+            return datetime.datetime.strptime(date, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def _julian_date(row, observation_date):
+    if 'jd' in row:
+        return float(row['jd'])
+    if observation_date is None:
+        return None
+    # 2440587.5 is the Julian date of the Unix epoch
+    delta = observation_date - datetime.datetime(1970, 1, 1)
+    return 2440587.5 + delta.total_seconds() / 86400.
+
+
+def get_state_id(connection, name):
+    """
+    Id of the ``State`` called ``name``, created if it does not exist.
+    """
+    table = models.State.__table__
+    row = connection.execute(
+        table.select().where(table.c.name == name)).first()
+    if row is not None:
+        return row.id
+    order = connection.execute(
+        sa.func.max(table.c.order).select()).scalar()
+    result = connection.execute(table.insert(), {
+        'name': name, 'order': 0 if order is None else order + 1,
+        'is_error': False})
+    return result.inserted_primary_key[0]
+
+
+def _frame_records(row, now):
+    """
+    ``('pawprint', values)`` or ``('calfile', values)`` for a summary row, or
+    ``None`` if the row lacks the values required by the table.
+    """
+    imagetype = row.get('imagetyp')
+    exptime = row.get('exptime')
+    if imagetype is None or exptime is None:
+        return None
+    observation_date = _observation_date(row)
+    if any(kind in imagetype.lower() for kind in _CALIBRATION_TYPES):
+        # the same image types the calibration library stores
+        return 'calfile', {'path': row['file'],
+                           'observation_date': observation_date,
+                           'exptime': int(round(exptime)),
+                           'created_at': now,
+                           'imagetype':
+                               models.calibration_imagetype(imagetype)}
+    jd = _julian_date(row, observation_date)
+    if jd is None:
+        return None
+    return 'pawprint', {'created_at': now,
+                        'modified_at': now,
+                        'observation_date': observation_date,
+                        'exptime': int(round(exptime)),
+                        'ccdtemp': row.get('ccd-temp'),
+                        'imagetype': imagetype[:16],
+                        'jd': jd,
+                        'targname': row.get('object'),
+                        'xbinning': row.get('xbinning', 1),
+                        'ybinning': row.get('ybinning', 1)}
+
+
+def ingest_frames(engine, rows, state='raw', campaign_id=None,
+                  batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Insert frames into the database with bulk inserts.
+    Calibration frames (bias, dark, flat) become ``CalFile`` rows; all
+    other frames become ``Pawprint`` rows with a ``StateChange`` to
+    ``state``. Rows are written with one executemany per table and batch,
+    each batch in its own transaction, instead of one ORM flush per file.
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine of a database with the tables of `models`.
+    rows : iterable of dict
+        Header values by lower case keyword, with ``'file'`` holding the
+        path of the frame, such as the ones yielded by `summary_rows`. Rows
+        are consumed as they come, so a scan can be streamed in.
+    state : str, optional
+        Name of the ``State`` of the new pawprints; it is created if
+        needed.
+    campaign_id : int, optional
+        ``Campaign`` of the new pawprints.
+    batch_size : int, optional
+        Number of frames written per transaction.
+    Returns
+    -------
+    dict
+        Number of ``'pawprint'``, ``'calfile'`` and ``'skipped'`` frames.
+    Notes
+    -----
+    Pawprint ids are read back from the inserts with ``RETURNING``, so
+    several processes can ingest into a database at the same time.
+    """
+    pawprints = models.Pawprint.__table__
+    statechanges = models.StateChange.__table__
+    calfiles = models.CalFile.__table__
+    counts = {'pawprint': 0, 'calfile': 0, 'skipped': 0}
+    start = time.time()
+
+    with engine.begin() as connection:
+        state_id = get_state_id(connection, state)
+    # ids of the new pawprints, in the order of the rows inserted
+    insert_pawprints = pawprints.insert().returning(
+        pawprints.c.id, sort_by_parameter_order=True)
+
+    def write(batch):
+        pawprint_rows = [values for kind, values in batch
+                         if kind == 'pawprint']
+        statechange_rows = [values for kind, values in batch
+                            if kind == 'statechange']
+        calfile_rows = [values for kind, values in batch
+                        if kind == 'calfile']
+        with engine.begin() as connection:
+            if pawprint_rows:
+                ids = connection.execute(insert_pawprints,
+                                         pawprint_rows).scalars().all()
+                for pawprint_id, values in zip(ids, statechange_rows):
+                    values['pawprint_id'] = pawprint_id
+                connection.execute(statechanges.insert(), statechange_rows)
+            if calfile_rows:
+                connection.execute(calfiles.insert(), calfile_rows)
+
+    batch = []
+    frames_in_batch = 0
+    for row in rows:
+        now = datetime.datetime.now()
+        record = _frame_records(row, now)
+        if record is None:
+            logger.warning('Not ingesting %s, it lacks the keywords needed',
+                           row.get('file'))
+            counts['skipped'] += 1
+            continue
+        kind, values = record
+        if kind == 'pawprint':
+            values['state_id'] = state_id
+            values['campaign_id'] = campaign_id
+            batch.append(('statechange', {'created_at': now,
+                                          'modified_at': now,
+                                          'count': 1,
+                                          'path': row['file'],
+                                          'state_id': state_id}))
+        batch.append((kind, values))
+        counts[kind] += 1
+        frames_in_batch += 1
+        if frames_in_batch >= batch_size:
+            write(batch)
+            batch = []
+            frames_in_batch = 0
+    if batch:
+        write(batch)
+
+    logger.info('Ingested %d pawprints and %d calibration files in %.3f s',
+                counts['pawprint'], counts['calfile'], time.time() - start)
+    return counts
+
+
+def _column_values(catalog, name, start, stop):
+    """
+    Values of a catalog column between two rows as Python objects, with
+    masked values as ``None``.
+    """
+    column = catalog[name][start:stop]
+    if hasattr(column, 'mask'):
+        return np.ma.asarray(column).tolist()
+    return np.asarray(column).tolist()
+
+
+def _catalog_names(catalog):
+    names = getattr(catalog, 'colnames', None)
+    if names is None:
+        names = catalog.dtype.names
+    return names
+
+
+def _load_catalog(engine, table, catalog, optional, fixed, batch_size):
+    """
+    Write the rows of ``catalog`` into ``table`` in batches of columns.
+    ``fixed`` holds values shared by every row, e.g. the pawprint id. The
+    HEALPix pixel of each row is computed here for the whole batch.
+    """
+    from spatial import healpix_index
+    names = _catalog_names(catalog)
+    missing = [name for name in _CATALOG_COLUMNS if name not in names]
+    if missing:
+        raise ValueError('catalog lacks columns {0}'.format(missing))
+    columns = _CATALOG_COLUMNS + [name for name in optional if name in names]
+    fixed_names = sorted(fixed)
+    all_names = columns + fixed_names + ['healpix']
+    n_rows = len(catalog)
+    start_time = time.time()
+
+    def batches():
+        for start in range(0, n_rows, batch_size):
+            stop = min(start + batch_size, n_rows)
+            values = [_column_values(catalog, name, start, stop)
+                      for name in columns]
+            values.extend([fixed[name]] * (stop - start)
+                          for name in fixed_names)
+            values.append(healpix_index(values[0], values[1]).tolist())
+            yield list(zip(*values))
+
+    if engine.dialect.name == 'sqlite':
+        # The DB-API executemany with tuples skips the per-row work of the
+        # SQLAlchemy layer, which dominates at these volumes.
+        statement = 'INSERT INTO "{0}" ({1}) VALUES ({2})'.format(
+            table.name, ', '.join('"{0}"'.format(name) for name in all_names),
+            ', '.join('?' * len(all_names)))
+        connection = engine.raw_connection()
+        cursor = connection.cursor()
+        saved = []
+        try:
+            for pragma, value in _SQLITE_BULK_PRAGMAS:
+                cursor.execute('PRAGMA {0}'.format(pragma))
+                saved.append((pragma, cursor.fetchone()[0]))
+                cursor.execute('PRAGMA {0} = {1}'.format(pragma, value))
+            for batch in batches():
+                cursor.executemany(statement, batch)
+            connection.commit()
+        finally:
+            connection.rollback()
+            for pragma, value in saved:
+                cursor.execute('PRAGMA {0} = {1}'.format(pragma, value))
+            connection.close()
+    else:
+        insert = table.insert()
+        with engine.begin() as connection:
+            for batch in batches():
+                connection.execute(insert, [dict(zip(all_names, row))
+                                            for row in batch])
+
+    seconds = time.time() - start_time
+    stats = LoadStats(n_rows, seconds,
+                      n_rows / seconds if seconds > 0 else float('inf'))
+    logger.info('Loaded %d rows into %s in %.3f s (%.0f rows/s)',
+                stats.rows, table.name, stats.seconds, stats.rows_per_second)
+    return stats
+
+
+def load_sources(engine, catalog, pawprint_id,
+                 batch_size=DEFAULT_CATALOG_BATCH_SIZE):
+    """
+    Insert the detections of a pawprint into the ``Source`` table.
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+    catalog : astropy.table.Table or numpy structured array
+        Detections, with columns ``ra``, ``dec``, ``mag``, ``mag_err`` and
+        optionally ``class_source``.
+    pawprint_id : int
+        ``Pawprint`` the detections belong to.
+    batch_size : int, optional
+        Number of rows per executemany. All batches are written in a single
+        transaction.
+    Returns
+    -------
+    LoadStats
+        Number of rows, time taken and rows per second.
+    """
+    return _load_catalog(engine, models.Source.__table__, catalog,
+                         ['class_source'], {'pawprint_id': pawprint_id},
+                         batch_size)
+
+
+def load_candidates(engine, catalog, pawprint_id=None, stack_id=None,
+                    batch_size=DEFAULT_CATALOG_BATCH_SIZE):
+    """
+    Insert transient candidates into the ``Candidate`` table.
+    The ``predicted`` column, if present, holds the codes of
+    ``Candidate.PREDICTED_TYPES`` (``'real'`` or ``'bogus'``). Other
+    parameters and the return value are as in `load_sources`.
+    """
+    return _load_catalog(engine, models.Candidate.__table__, catalog,
+                         ['predicted'], {'pawprint_id': pawprint_id,
+                                         'stack_id': stack_id},
+                         batch_size)
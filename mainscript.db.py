@@ -48,6 +48,13 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir", help="Input the directory to be processed.", \
                                                                     type=str)
+    parser.add_argument("--db", default=None,
+        help="Database URL the frames are entered into; $TORITOS_DB or "
+             "sqlite:///toritos-dev.db by default.")
+    parser.add_argument("--batch-size", type=int, default=1000,
+        help="Number of frames entered per database transaction.")
+    parser.add_argument("--echo", action='store_true', default=False,
+        help="Log the SQL statements.")
     args = parser.parse_args()
 
     timestamp = time.strftime("%Y%m%d_%H%M%S")
@@ -64,27 +71,28 @@ if __name__ == "__main__":
     todayspath = os.path.join(dataRootFolder, todaysfolder)
     if os.path.exists(todayspath):
 
-        #Gather all FITS files into a list to be iterated over
-        allfitsfiles = [os.path.join(root, afile) for root, dirs, files \
-                in os.walk(todayspath) for afile in files if '.fit' in afile]
-        
-        #import models
-        #engine = sa.create_engine('sqlite:///toritos-dev.db', echo=True)
-        #Session = sa.orm.sessionmaker()
-        #Session.configure(bind=engine)
-        #models.Model.metadata.create_all(engine)
-
-
-        for afile in allfitsfiles:
-            print afile
-            #Enter each file into database
-            enterFileInDB(afile, step='raw')
-            #Reduce each file
-            # *Create master dark or bias frames
-            # *Create master flat frame
-            # *Enter both masters and individual files into database
-            # *Do the processing
-            # *Enter the data into the database
+        import models
+        from db import create_engine
+        from image_collection import ImageFileCollection
+        from ingest import ingest_frames, summary_rows, INGEST_KEYWORDS
+
+        engine = create_engine(args.db, echo=args.echo)
+        models.Model.metadata.create_all(engine)
+
+        #Enter all FITS files into the database in batches
+        allfits = ImageFileCollection(todayspath, keywords=INGEST_KEYWORDS,
+                                      recursive=True)
+        counts = ingest_frames(engine, summary_rows(allfits),
+                               batch_size=args.batch_size)
+        logger.info("Entered %d pawprints and %d calibration files." % \
+            (counts['pawprint'], counts['calfile']))
+
+        #Reduce each file
+        # *Create master dark or bias frames
+        # *Create master flat frame
+        # *Enter both masters and individual files into database
+        # *Do the processing
+        # *Enter the data into the database
 
     else:
         logger.warning("Folder %s not found. Ending script." % (todayspath))
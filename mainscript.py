@@ -4,13 +4,20 @@
 TODO: DOCS
 """
 import time
+import datetime
 import os
 import logging
+import multiprocessing
 import ccdproc
 import numpy as np
 from astropy.io import fits
 from astropy import units as u
 
+from combine import tiled_combine, calibration_transform
+from pipeline import run_pipeline, DEFAULT_QUEUE_DEPTH
+from reduction import calibrate, normalized_flat, working_array, DarkIndex
+from master_cache import MasterCache, MASTER_CACHE_NAME
+
 DATA_ROOT = "/Users/utb/Desktop/dataToTestPipeline/observations"
 
 
@@ -34,16 +41,15 @@ def startLogger(loggerName, logFilename):
     logger.addHandler(ch)
 
 
-def chooseClosestDark(darklists, exptime):
-    best_t = np.inf
-    for anexp in darklists.iterkeys():
-        if abs(anexp - exptime) < best_t:
-            best_t = anexp
-    return darklists[best_t]
-
+def combineBias(biaslist, mem_limit=None, processes=1, fast=False):
+    """Combine all the bias files into a master bias.
 
-def combineBias(biaslist):
-    """Combine all the bias files into a master bias"""
+    If any of mem_limit, processes or fast is set, the frames are combined
+    by combine.tiled_combine; see it for their meaning.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        return tiled_combine(biaslist, method='median', mem_limit=mem_limit,
+                             processes=processes, fast=fast)
     ccdlist = [ccdproc.CCDData.read(abias, unit="adu") for abias in biaslist]
     biasComb = ccdproc.Combiner(ccdlist)
     #biasComb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
@@ -51,8 +57,17 @@ def combineBias(biaslist):
     return biasmaster
 
 
-def combineDarks(darklist):
-    """Combine all the dark files into a master dark"""
+def combineDarks(darklist, mem_limit=None, processes=1, fast=False):
+    """Combine all the dark files into a master dark.
+
+    mem_limit, processes and fast: see combine.tiled_combine.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        darkmaster = tiled_combine(darklist, method='median',
+                                   mem_limit=mem_limit, processes=processes,
+                                   fast=fast)
+        darkmaster.header['exptime'] = fits.getval(darklist[0], 'exptime')
+        return darkmaster
     darkComb = ccdproc.Combiner([ccdproc.CCDData.read(adark, unit="adu") \
         for adark in darklist])
     #darkComb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
@@ -61,8 +76,18 @@ def combineDarks(darklist):
     return darkmaster
 
 
-def combineFlats(flatlist, dark=None, bias=None):
-    """Combine all flat files into a flat master. Subtract dark or bias if provided."""
+def combineFlats(flatlist, dark=None, bias=None, mem_limit=None,
+                 processes=1, fast=False):
+    """Combine all flat files into a flat master. Subtract dark or bias if provided.
+
+    mem_limit, processes and fast: see combine.tiled_combine, where dark
+    or bias are subtracted band by band.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        return tiled_combine(flatlist, method='median', mem_limit=mem_limit,
+                             processes=processes, fast=fast,
+                             scale=lambda arr: 1./np.ma.average(arr),
+                             transform=calibration_transform(dark, bias))
     ccdflatlist = [ccdproc.CCDData.read(aflat, unit="adu") for aflat in flatlist]
     if dark is not None and bias is None:
         flat_sub = [ccdproc.subtract_dark(aflat, dark, exposure_time='exptime',\
@@ -79,6 +104,79 @@ def combineFlats(flatlist, dark=None, bias=None):
     return flatmaster
 
 
+def cachedMaster(cache, kind, filelist, combine, **params):
+    """Return the master combined by combine() from the files in filelist,
+    or the one stored in cache for the same files and params. Returns the
+    master and its cache key (None if cache is None)."""
+    if cache is None:
+        return combine(), None
+    key = cache.key(kind, filelist, **params)
+    return cache.fetch(key, combine), key
+
+
+def calibrationSession(url):
+    """Session on the calibration library database, creating its tables if
+    needed."""
+    from db import Database
+    return Database(url, create_tables=True).Session()
+
+
+def nightDate(todaysfolder):
+    """Date of a night folder named YYYYMMDD, or now if the name is not a
+    date."""
+    try:
+        return datetime.datetime.strptime(os.path.basename(
+            os.path.normpath(todaysfolder)), "%Y%m%d")
+    except ValueError:
+        return datetime.datetime.now()
+
+
+def frameSetup(summary, afile):
+    """Binning and CCD temperature of a file of an ImageFileCollection
+    summary, as keyword arguments of CalibrationLibrary.best and add."""
+    row = list(summary['file']).index(afile)
+    setup = {}
+    for key, name, default in [('xbinning', 'xbinning', 1),
+                               ('ybinning', 'ybinning', 1),
+                               ('ccd-temp', 'ccdtemp', None)]:
+        value = summary[key][row] if key in summary.colnames else None
+        if value is None or value is np.ma.masked:
+            value = default
+        setup[name] = value.item() if hasattr(value, 'item') else value
+    return setup
+
+
+def masterFromLibrary(library, imagetype, nightdate, setup, exptime=None):
+    """Read the master of the calibration library that best matches the
+    night. Returns the master and its path, or (None, None)."""
+    logger = logging.getLogger('loaderscript')
+    libmaster = library.best(imagetype, nightdate, exptime=exptime, **setup)
+    if libmaster is None:
+        logger.warning("No %s master in the calibration library%s." % \
+            (imagetype, "" if exptime is None else " for %ss" % exptime))
+        return None, None
+    logger.info("Using %s master from the calibration library: %s." % \
+        (imagetype, libmaster.path))
+    master = ccdproc.CCDData.read(libmaster.path, unit='adu')
+    if libmaster.exptime is not None:
+        master.header['exptime'] = libmaster.exptime
+    return master, libmaster.path
+
+
+def exitMissingMaster(imagetype, todaysfolder, setup, exptimes=None):
+    """Log that the night has no master of imagetype, neither from its own
+    frames nor from the calibration library, and end the script."""
+    import sys
+    logger = logging.getLogger('loaderscript')
+    description = ", ".join("%s=%s" % item for item in sorted(setup.items()))
+    if exptimes:
+        description += ", exptime=%s" % (sorted(float(anexp) \
+            for anexp in exptimes),)
+    logger.error("No %s master for night %s (%s). Ending script." % \
+        (imagetype, todaysfolder, description))
+    sys.exit(2)
+
+
 def saveCCDDataAndLog(outpath, calibfile):
     logger = logging.getLogger('loaderscript')
     try:
@@ -88,6 +186,148 @@ def saveCCDDataAndLog(outpath, calibfile):
         logger.error("Error writing calibration image to file: %s." %(outpath))
 
 
+def readScience(ascience):
+    """Read a raw science frame. Returns the frame and its header.
+
+    The file is opened once and both come from that single read.
+    """
+    with fits.open(ascience, memmap=False) as hdulist:
+        header = hdulist[0].header
+        data = hdulist[0].data
+    return ccdproc.CCDData(data, unit='adu', meta=header), header
+
+
+def reduceScience(sci_image, flatmaster, biasmaster=None, darkindex=None,
+                  exp_time=None):
+    """Subtract the bias, or the dark from darkindex (a reduction.DarkIndex)
+    if no bias is given, from a science frame and flat correct it.
+
+    exp_time is used to pick the dark; if not given, it is taken from the
+    header of the frame.
+    """
+    if biasmaster is not None:
+        sci_biassub = ccdproc.subtract_bias(sci_image, biasmaster)
+        return ccdproc.flat_correct(sci_biassub, flatmaster)
+    if exp_time is None:
+        exp_time = sci_image.header['exptime']
+    darkmaster = darkindex.dark(exp_time)
+    sci_darksub = ccdproc.subtract_dark(sci_image, darkmaster, \
+        exposure_time='exptime', exposure_unit=u.second)
+    return ccdproc.flat_correct(sci_darksub, flatmaster)
+
+
+def prepareMasters(flatmaster, biasmaster=None, darklists=None,
+                   darkmode='nearest', dtype=np.float32):
+    """Convert the master frames once to the arrays used by
+    reduceScienceFast. The darks are indexed with a DarkIndex in darkmode.
+    The mask of the flat is kept to flag the same pixels of the reduced
+    frames as ccdproc.flat_correct does."""
+    flatmask = getattr(flatmaster, 'mask', None)
+    if flatmask is not None and not flatmask.any():
+        flatmask = None
+    prepared = {'dtype': dtype,
+                'flat': normalized_flat(flatmaster, dtype),
+                'flatmask': flatmask,
+                'bias': working_array(biasmaster, dtype)}
+    if darklists is not None:
+        prepared['darks'] = DarkIndex(dict((anexp, \
+            working_array(adark, dtype)) for anexp, adark in darklists.items()),
+            mode=darkmode)
+    return prepared
+
+
+def reduceScienceFast(sci_image, prepared, exp_time=None):
+    """Same as reduceScience, with the masters from prepareMasters and
+    reduction.calibrate doing the subtraction and flat division in place
+    on a single buffer."""
+    if prepared['bias'] is not None:
+        data = calibrate(sci_image.data, prepared['flat'],
+                         bias=prepared['bias'], dtype=prepared['dtype'],
+                         overwrite_input=True)
+    else:
+        if exp_time is None:
+            exp_time = sci_image.header['exptime']
+        dark = prepared['darks'].dark(exp_time)
+        data = calibrate(sci_image.data, prepared['flat'], dark=dark,
+                         dtype=prepared['dtype'], overwrite_input=True)
+    return ccdproc.CCDData(data, unit=sci_image.unit, meta=sci_image.meta,
+                           mask=prepared.get('flatmask'))
+
+
+def writeScience(outpath, header, sci_flatcorrected,
+                 deadpixmaskfilename=None):
+    """Write a reduced science frame with the header of the raw frame."""
+    hdu_img = fits.PrimaryHDU(sci_flatcorrected.data, header=header)
+    if deadpixmaskfilename is not None:
+        hdu_deadpix_mask = fits.ImageHDU(fits.getdata(deadpixmaskfilename), \
+            name='DEAD_PIX_MASK')
+        hdulist = fits.HDUList([hdu_img, hdu_deadpix_mask])
+    else:
+        hdulist = fits.HDUList([hdu_img])
+    hdulist.writeto(outpath, clobber=True)
+
+
+# Master frames of a science worker, set once per process by
+# initScienceWorker so they are not sent along with every frame.
+_science_masters = {}
+
+
+def initScienceWorker(masters):
+    _science_masters.clear()
+    _science_masters.update(masters)
+
+
+# The three stages of a science frame: read, reduce and write. Each one
+# takes what the previous one returns, so they can run one after the other
+# in a worker process or as the stages of pipeline.run_pipeline. A frame
+# that can't be read or reduced is passed along as None.
+def readScienceTask(task):
+    ascience, outpath, exp_time = task
+    try:
+        return task, readScience(ascience)
+    except Exception:
+        return task, None
+
+
+def reduceScienceTask(read_result):
+    task, frame = read_result
+    if frame is None:
+        return task, None, None
+    sci_image, header = frame
+    try:
+        if 'prepared' in _science_masters:
+            sci_flatcorrected = reduceScienceFast(sci_image,
+                _science_masters['prepared'], exp_time=task[2])
+        else:
+            sci_flatcorrected = reduceScience(sci_image,
+                _science_masters['flatmaster'],
+                biasmaster=_science_masters.get('biasmaster'),
+                darkindex=_science_masters.get('darkindex'),
+                exp_time=task[2])
+    except Exception:
+        return task, None, None
+    return task, sci_flatcorrected, header
+
+
+def writeScienceTask(reduce_result):
+    """Write a reduced frame. Returns the input path and whether it could
+    be reduced."""
+    (ascience, outpath, exp_time), sci_flatcorrected, header = \
+        reduce_result
+    if sci_flatcorrected is None:
+        return ascience, False
+    writeScience(outpath, header, sci_flatcorrected,
+                 _science_masters.get('deadpixmaskfilename'))
+    return ascience, True
+
+
+def reduceAndWriteScience(task):
+    """Reduce and write one (input, output, exposure time) science task
+    using the masters of this worker. Returns the input path and whether it could
+    be reduced."""
+    return writeScienceTask(reduceScienceTask(readScienceTask(task)))
+
+
 if __name__ == "__main__":
     import sys
     import argparse
@@ -98,7 +338,38 @@ if __name__ == "__main__":
     parser.add_argument("--usebias", action='store_true', 
         help="Use bias frames instead of darks in reduction.",
         default=False)
+    parser.add_argument("--mem-limit", type=float, default=None,
+        help="Memory budget in MB for combining calibration frames. "
+        "If not given, whole frames are loaded.")
+    parser.add_argument("--combine-processes", type=int, default=1,
+        help="Number of processes used to combine calibration frames.")
+    parser.add_argument("--fast-combine", action='store_true', default=False,
+        help="Combine calibration frames with the float32 kernel.")
+    parser.add_argument("--no-master-cache", action='store_true',
+        default=False,
+        help="Combine the master calibration frames even if masters of "
+        "the same frames are in the master cache of the night.")
+    parser.add_argument("--dark-scaling", choices=DarkIndex.modes,
+        default='nearest',
+        help="Dark subtracted from science frames: the master with the "
+        "nearest exposure time, that master scaled to the exposure time of "
+        "the frame, or the interpolation of the two bracketing masters.")
+    parser.add_argument("--calib-db", default=None,
+        help="Database URL of the calibration library, e.g. "
+        "sqlite:///calibrations.db. Masters missing from the night are "
+        "taken from it and the new masters are added to it.")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes used to reduce science frames.")
+    parser.add_argument("--queue-depth", type=int,
+        default=DEFAULT_QUEUE_DEPTH,
+        help="Number of science frames read ahead and waiting to be "
+        "written when reducing in a single process.")
+    parser.add_argument("--fast-reduce", nargs='?', const='float32',
+        choices=['float32', 'float64'], default=None,
+        help="Calibrate science frames in place with reduction.calibrate, "
+        "in float32 unless float64 is given.")
     args = parser.parse_args()
+    mem_limit = args.mem_limit * 1e6 if args.mem_limit is not None else None
 
     timestamp = time.strftime("%Y%m%d_%H%M%S")
     startLogger("loaderscript", 'mainscript_' + timestamp + '.log')
@@ -117,8 +388,15 @@ if __name__ == "__main__":
         sys.exit(2)
 
     #Gather all FITS files into a list to be iterated over
-    allfitsfiles = [os.path.join(root, afile) for root, dirs, files \
-            in os.walk(todayspath) for afile in files if '.fit' in afile]
+    #(but not the masters kept in the master cache or the results of an
+    #earlier run, which the calibration library may point to)
+    allfitsfiles = []
+    for root, dirs, files in os.walk(todayspath):
+        for skipped in [MASTER_CACHE_NAME, '02_preprocessed']:
+            if skipped in dirs:
+                dirs.remove(skipped)
+        allfitsfiles.extend(os.path.join(root, afile) for afile in files \
+            if '.fit' in afile)
     rawpath = os.path.join(todayspath, '01_raw')
     try:
         if not os.path.exists(rawpath):
@@ -141,40 +419,114 @@ if __name__ == "__main__":
     from image_collection import ImageFileCollection
 
     #Create an image file collection storing the following keys
-    keys = ['imagetyp', 'object', 'filter', 'exptime']
-    allfits = ImageFileCollection(rawpath, keywords=keys)
+    keys = ['imagetyp', 'object', 'filter', 'exptime', 'xbinning', 'ybinning',
+            'ccd-temp']
+    allfits = ImageFileCollection(rawpath, keywords=keys, use_cache=True)
+    #Exposure times come from the summary so no file is opened just for them
+    exptimes = dict(zip(allfits.summary['file'], allfits.summary['exptime']))
+
+    #Masters combined from unchanged frames in an earlier run are reused
+    if args.no_master_cache:
+        mastercache = None
+    else:
+        mastercache = MasterCache(os.path.join(todayspath, MASTER_CACHE_NAME))
+
+    #Collect all science files
+    sciencelist = allfits.files_filtered(imagetyp='light')
+
+    #Masters missing from the night are taken from the calibration library,
+    #and the masters combined here are added to it
+    nightdate = nightDate(todaysfolder)
+    setup = frameSetup(allfits.summary, sciencelist[0] \
+        if len(sciencelist) else allfits.summary['file'][0])
+    if args.calib_db is not None:
+        from calibration_library import CalibrationLibrary
+        library = CalibrationLibrary(calibrationSession(args.calib_db))
+    else:
+        library = None
+    newmasters = []
 
     #Collect all dark files and make a dark frame for each diff co time
     dark_matches = np.ma.array(['dark' in atype.lower() \
                                    for atype in allfits.summary['imagetyp']])
     darkexp_set = set(allfits.summary['exptime'][dark_matches])
     darklists = {}
+    darkkeys = {}
     for anexp in darkexp_set:
         my_darks = allfits.summary['file'][(\
                        allfits.summary['exptime'] == anexp) & dark_matches]
         my_darks = [os.path.join(rawpath, adark) for adark in my_darks]
-        darklists[anexp] = combineDarks(my_darks)
-
-    #Collect all science files
-    sciencelist = allfits.files_filtered(imagetyp='light')
-    sciencelist = [os.path.join(rawpath, afile) for afile in sciencelist]
+        darklists[anexp], darkkeys[anexp] = cachedMaster(mastercache, 'dark',
+            my_darks, lambda: combineDarks(my_darks, mem_limit=mem_limit,
+                                           processes=args.combine_processes,
+                                           fast=args.fast_combine),
+            fast=args.fast_combine)
+        if not args.usebias:
+            newmasters.append(('dark', anexp, my_darks))
+    lightexp_set = set(exptimes[afile] for afile in sciencelist) | \
+        set(allfits.summary['exptime'][np.ma.array(['flat' in \
+            atype.lower() for atype in allfits.summary['imagetyp']])])
+    if not darkexp_set and not args.usebias and library is not None:
+        for anexp in lightexp_set:
+            darkmaster, darkpath = masterFromLibrary(library, 'dark',
+                                                     nightdate, setup, anexp)
+            if darkmaster is not None:
+                darkexp = darkmaster.header['exptime']
+                darklists[darkexp], darkkeys[darkexp] = darkmaster, darkpath
+    if not args.usebias and not darklists:
+        exitMissingMaster('dark', todaysfolder, setup, lightexp_set)
 
     #Collect all bias files
     bias_matches = np.ma.array([('zero' in typ.lower() or 'bias' \
         in typ.lower()) for typ in allfits.summary['imagetyp']])
     biaslist = allfits.summary['file'][bias_matches]
     biaslist = [os.path.join(rawpath, afile) for afile in biaslist]
-    biasmaster = combineBias(biaslist)
+    if len(biaslist):
+        biasmaster, biaskey = cachedMaster(mastercache, 'bias', biaslist,
+            lambda: combineBias(biaslist, mem_limit=mem_limit,
+                                processes=args.combine_processes,
+                                fast=args.fast_combine),
+            fast=args.fast_combine)
+        if args.usebias:
+            newmasters.append(('bias', None, biaslist))
+    elif args.usebias and library is not None:
+        biasmaster, biaskey = masterFromLibrary(library, 'bias', nightdate,
+                                                setup)
+    else:
+        biasmaster, biaskey = None, None
+    if args.usebias and biasmaster is None:
+        exitMissingMaster('bias', todaysfolder, setup)
 
     #Create the flat master
     flatlist = allfits.files_filtered(imagetyp='flat')
     flatlist = [os.path.join(rawpath, aflat) for aflat in flatlist]
-    if args.usebias:
-        flatmaster = combineFlats(flatlist, bias=biasmaster)
+    if not len(flatlist):
+        flatmaster, flatkey = None, None
+        if library is not None:
+            flatmaster, flatkey = masterFromLibrary(library, 'flat',
+                                                    nightdate, setup)
+        if flatmaster is None:
+            exitMissingMaster('flat', todaysfolder, setup)
+    elif args.usebias:
+        flatmaster, flatkey = cachedMaster(mastercache, 'flat', flatlist,
+            lambda: combineFlats(flatlist, bias=biasmaster,
+                                 mem_limit=mem_limit,
+                                 processes=args.combine_processes,
+                                 fast=args.fast_combine),
+            fast=args.fast_combine, bias=biaskey)
+        newmasters.append(('flat', None, flatlist))
     else:
-        exptime = fits.getval(flatlist[0], 'exptime')
-        darkmaster = chooseClosestDark(darklists, exptime)
-        flatmaster = combineFlats(flatlist, dark=darkmaster)
+        exptime = exptimes[os.path.basename(flatlist[0])]
+        darkindex = DarkIndex(darklists)
+        darkmaster = darkindex.nearest(exptime)
+        darkkey = darkkeys[darkindex.nearest_exptime(exptime)]
+        flatmaster, flatkey = cachedMaster(mastercache, 'flat', flatlist,
+            lambda: combineFlats(flatlist, dark=darkmaster,
+                                 mem_limit=mem_limit,
+                                 processes=args.combine_processes,
+                                 fast=args.fast_combine),
+            fast=args.fast_combine, dark=darkkey)
+        newmasters.append(('flat', None, flatlist))
 
     preprocessedpath = os.path.join(todayspath, '02_preprocessed')
     try:
@@ -196,35 +548,59 @@ if __name__ == "__main__":
     outpath = os.path.join(preprocessedpath, 'flat_master.fits')
     saveCCDDataAndLog(outpath, flatmaster)
 
-    for ascience in sciencelist:
-        try:
-            sci_image = ccdproc.CCDData.read(ascience, unit='adu')
-            if args.usebias:
-                sci_biassub = ccdproc.subtract_bias(sci_image, biasmaster)
-                sci_flatcorrected = ccdproc.flat_correct(sci_biassub, flatmaster)
+    if library is not None:
+        for imagetype, anexp, inputs in newmasters:
+            if imagetype == 'dark':
+                masterpath = os.path.join(preprocessedpath, \
+                    'dark_master_' + str(anexp) + 's.fits')
             else:
-                exp_time = fits.getval(ascience, 'exptime')
-                darkmaster = chooseClosestDark(darklists, exp_time)
-                sci_darksub = ccdproc.subtract_dark(sci_image, darkmaster, \
-                    exposure_time='exptime', exposure_unit=u.second)
-                sci_flatcorrected = ccdproc.flat_correct(sci_darksub, flatmaster)
-        except:
-            logger.error("Couldn't reduce image %s." % (ascience))
-            continue
-        outpath = os.path.join(preprocessedpath, \
-                 'preprocessed_' + os.path.basename(ascience))
-
-        #deadpixmaskfilename = "../stackImages/deadpix.fits"
-        deadpixmaskfilename = None
-
-        hdu_img = fits.PrimaryHDU(sci_flatcorrected.data, \
-            header=fits.getheader(ascience))
-        if deadpixmaskfilename is not None:
-            hdu_deadpix_mask = fits.ImageHDU(fits.getdata(deadpixmaskfilename), \
-                name='DEAD_PIX_MASK')
-            hdulist = fits.HDUList([hdu_img, hdu_deadpix_mask])
-        else:
-            hdulist = fits.HDUList([hdu_img])
-        hdulist.writeto(outpath, clobber=True)
+                masterpath = os.path.join(preprocessedpath, \
+                    imagetype + '_master.fits')
+            calfiles = [(afile, float(exptimes[os.path.basename(afile)])) \
+                        for afile in inputs]
+            library.add(os.path.abspath(masterpath), imagetype, nightdate,
+                        exptime=None if anexp is None else float(anexp),
+                        calfiles=calfiles, **setup)
+
+    #deadpixmaskfilename = "../stackImages/deadpix.fits"
+    deadpixmaskfilename = None
+
+    masters = {'flatmaster': flatmaster,
+               'deadpixmaskfilename': deadpixmaskfilename}
+    if args.usebias:
+        masters['biasmaster'] = biasmaster
+    else:
+        masters['darkindex'] = DarkIndex(darklists, mode=args.dark_scaling)
+    if args.fast_reduce is not None:
+        masters['prepared'] = prepareMasters(flatmaster,
+            biasmaster=masters.get('biasmaster'),
+            darklists=None if args.usebias else darklists,
+            darkmode=args.dark_scaling, dtype=args.fast_reduce)
+    tasks = [(os.path.join(rawpath, afile), os.path.join(preprocessedpath, \
+                 'preprocessed_' + afile), exptimes[afile]) \
+             for afile in sciencelist]
+
+    if args.workers > 1:
+        # The masters reach each worker once, through the pool initializer
+        # (inherited on fork), and only file names travel per frame.
+        pool = multiprocessing.Pool(args.workers,
+            initializer=initScienceWorker, initargs=(masters,))
+        try:
+            results = pool.imap_unordered(reduceAndWriteScience, tasks)
+            for ascience, reduced in results:
+                if not reduced:
+                    logger.error("Couldn't reduce image %s." % (ascience))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        # Read the next frames and write the finished ones in background
+        # threads while the current frame is being reduced.
+        initScienceWorker(masters)
+        results = run_pipeline(tasks, readScienceTask, reduceScienceTask,
+                               writeScienceTask, depth=args.queue_depth)
+        for ascience, reduced in results:
+            if not reduced:
+                logger.error("Couldn't reduce image %s." % (ascience))
 
 
@@ -0,0 +1,114 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import hashlib
+import json
+import logging
+import os
+from os import path
+
+import ccdproc
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['MasterCache', 'MASTER_CACHE_NAME']
+
+#: Name of the directory holding the cached masters of a night, inside the
+#: night folder (``<night>/.master_cache``).
+MASTER_CACHE_NAME = '.master_cache'
+
+
+class MasterCache(object):
+
+    """
+    Directory of master calibration frames keyed by their inputs.
+    A master is stored as ``<key>.fits``, where the key is a hash of the
+    kind of master, the sorted input files with their sizes and modification
+    times, and the parameters used to combine them. Combining the same
+    unchanged frames with the same parameters again finds the stored master
+    instead of building it.
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cache; it is created if needed.
+    """
+
+    def __init__(self, cache_dir):
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._dir = cache_dir
+
+    @property
+    def location(self):
+        """
+        str, Directory of the cache.
+        """
+        return self._dir
+
+    def key(self, kind, file_names, **params):
+        """
+        Fingerprint of a master.
+        Parameters
+        ----------
+        kind : str
+            Type of master, e.g. ``'bias'``, ``'dark'`` or ``'flat'``.
+        file_names : list of str
+            Paths of the frames combined into the master. Their order does
+            not matter.
+        params
+            Any other value the master depends on, such as the combine
+            method or the key of the master dark subtracted from the flats.
+            Values must be JSON serializable.
+        Returns
+        -------
+        str
+        """
+        files = []
+        for file_name in sorted(file_names, key=path.basename):
+            stat = os.stat(file_name)
+            files.append([path.basename(file_name), stat.st_size,
+                          stat.st_mtime])
+        description = json.dumps([kind, files, params], sort_keys=True)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return path.join(self._dir, key + '.fits')
+
+    def get(self, key):
+        """
+        Cached master for a key, as a `ccdproc.CCDData`, or ``None``.
+        """
+        file_name = self._path(key)
+        if not path.exists(file_name):
+            return None
+        try:
+            return ccdproc.CCDData.read(file_name, unit='adu')
+        except Exception:
+            logger.warning('Could not read cached master %s, it will be '
+                           'combined again', file_name)
+            return None
+
+    def put(self, key, master):
+        """
+        Store a master. The file is written under a temporary name and then
+        renamed, so an interrupted run never leaves a partial master behind.
+        """
+        file_name = self._path(key)
+        temp_name = file_name + '.part'
+        if path.exists(temp_name):
+            os.remove(temp_name)
+        master.to_hdu().writeto(temp_name)
+        os.rename(temp_name, file_name)
+
+    def fetch(self, key, combine):
+        """
+        Cached master for ``key``, or the result of ``combine()``, which is
+        then stored under ``key``.
+        """
+        master = self.get(key)
+        if master is not None:
+            logger.debug('Using cached master %s', key)
+            return master
+        master = combine()
+        self.put(key, master)
+        return master
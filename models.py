@@ -8,6 +8,26 @@ from sqlalchemy.ext.declarative import declarative_base
 Model = declarative_base()
 
 
+def calibration_imagetype(imagetype):
+    """Canonical image type of a calibration frame or master, as stored in
+    CalFile and MasterCal: 'bias', 'dark' or 'flat' for header values
+    such as 'Dark Frame' or 'ZERO'; other values are only lower cased."""
+    imagetype = imagetype.lower()
+    for known in ['bias', 'dark', 'flat']:
+        if known in imagetype:
+            return known
+    if 'zero' in imagetype:
+        return 'bias'
+    return imagetype
+
+
+def healpix_default(context):
+    """Column default filling the healpix pixel of a row from its ra/dec."""
+    from spatial import healpix_index
+    params = context.current_parameters
+    return healpix_index(params['ra'], params['dec'])
+
+
 class Observatory(Model):
 
     __tablename__ = 'Observatory'
@@ -83,7 +103,8 @@ class StateChange(Model):
     state_id = sa.Column(sa.Integer, sa.ForeignKey('State.id'))
     state = sa.orm.relationship(
         "State", backref=sa.orm.backref('statechanges', order_by=id))
-    pawprint_id = sa.Column(sa.Integer, sa.ForeignKey('Pawprint.id'))
+    pawprint_id = sa.Column(sa.Integer, sa.ForeignKey('Pawprint.id'),
+                            index=True)
     pawprint = sa.orm.relationship(
         "Pawprint", backref=sa.orm.backref('statechanges', order_by=id))
 
@@ -114,9 +135,13 @@ class Source(Model):
     dec = sa.Column(sa.Float, nullable=False)
     mag = sa.Column(sa.Float, nullable=False)
     mag_err = sa.Column(sa.Float, nullable=False)
+    # HEALPix pixel of (ra, dec), see spatial.py
+    healpix = sa.Column(sa.BigInteger, nullable=True, index=True,
+                        default=healpix_default)
     class_source = sa.Column(sa.String, nullable=True)
 
-    pawprint_id = sa.Column(sa.Integer, sa.ForeignKey('Pawprint.id'))
+    pawprint_id = sa.Column(sa.Integer, sa.ForeignKey('Pawprint.id'),
+                            index=True)
     pawprint = sa.orm.relationship(
         "Pawprint", backref=sa.orm.backref('sources', order_by=id))
 
@@ -137,12 +162,16 @@ class Candidate(Model):
     dec = sa.Column(sa.Float, nullable=False)
     mag = sa.Column(sa.Float, nullable=False)
     mag_err = sa.Column(sa.Float, nullable=False)
+    # HEALPix pixel of (ra, dec), see spatial.py
+    healpix = sa.Column(sa.BigInteger, nullable=True, index=True,
+                        default=healpix_default)
     predicted = sa.Column(sau.ChoiceType(PREDICTED_TYPES), nullable=True)
 
-    pawprint_id = sa.Column(sa.Integer, sa.ForeignKey('Pawprint.id'))
+    pawprint_id = sa.Column(sa.Integer, sa.ForeignKey('Pawprint.id'),
+                            index=True)
     pawprint = sa.orm.relationship(
         "Pawprint", backref=sa.orm.backref('candidates', order_by=id))
-    stack_id = sa.Column(sa.Integer, sa.ForeignKey('Stack.id'))
+    stack_id = sa.Column(sa.Integer, sa.ForeignKey('Stack.id'), index=True)
     stack = sa.orm.relationship(
         "Stack", backref=sa.orm.backref('candidates', order_by=id))
 
@@ -189,6 +218,12 @@ class StackStateChange(Model):
 class Pawprint(Model):
 
     __tablename__ = 'Pawprint'
+    # work queues of the scheduler: pawprints in a state, oldest first
+    __table_args__ = (
+        sa.Index('ix_Pawprint_state_modified', 'state_id', 'modified_at'),
+        # pawprints of a campaign in observing order
+        sa.Index('ix_Pawprint_campaign_jd', 'campaign_id', 'jd'),
+    )
 
     id = sa.Column(sa.Integer, primary_key=True)
     created_at = sa.Column(sa.DateTime(timezone=True))
@@ -200,7 +235,7 @@ class Pawprint(Model):
     exptime = sa.Column(sa.Integer, nullable=False)
     ccdtemp = sa.Column(sa.Float, nullable=True)
     imagetype = sa.Column(sa.String(16), nullable=False)
-    jd = sa.Column(sa.Float, nullable=False)
+    jd = sa.Column(sa.Float, nullable=False, index=True)
     targname = sa.Column(sa.String(40), nullable=True)
     xbinning = sa.Column(sa.Integer, nullable=False)
     ybinning = sa.Column(sa.Integer, nullable=False)
@@ -212,6 +247,9 @@ class Pawprint(Model):
     campaign = sa.orm.relationship(
         "Campaign", backref=sa.orm.backref('pawprints', order_by=id))
 
+    # token of the scheduler claim the pawprint is being processed under
+    claimed_by = sa.Column(sa.String(32), nullable=True)
+
     def repr(self):
         return self.id
 
@@ -239,6 +277,13 @@ class MasterCal(Model):
     path = sa.Column(sa.Text, nullable=True)
     imagetype = sa.Column(sa.String(40), nullable=False)
 
+    # what the master can be matched on when reducing other nights
+    observation_date = sa.Column(sa.DateTime(timezone=True), nullable=True)
+    exptime = sa.Column(sa.Float, nullable=True)
+    ccdtemp = sa.Column(sa.Float, nullable=True)
+    xbinning = sa.Column(sa.Integer, nullable=True)
+    ybinning = sa.Column(sa.Integer, nullable=True)
+
     def repr(self):
         return self.id
 
@@ -249,10 +294,12 @@ class Combination(Model):
 
     id = sa.Column(sa.Integer, primary_key=True)
 
-    calfile_id = sa.Column(sa.Integer, sa.ForeignKey('CalFile.id'))
+    calfile_id = sa.Column(sa.Integer, sa.ForeignKey('CalFile.id'),
+                           index=True)
     calfile = sa.orm.relationship(
         "CalFile", backref=sa.orm.backref('combinations', order_by=id))
-    mastercal_id = sa.Column(sa.Integer, sa.ForeignKey('MasterCal.id'))
+    mastercal_id = sa.Column(sa.Integer, sa.ForeignKey('MasterCal.id'),
+                             index=True)
     mastercal = sa.orm.relationship(
         "MasterCal", backref=sa.orm.backref('combinations', order_by=id))
 
@@ -263,6 +310,11 @@ class Combination(Model):
 class CalFile(Model):
 
     __tablename__ = 'CalFile'
+    # calibration frames of a type and exposure time around a date
+    __table_args__ = (
+        sa.Index('ix_CalFile_type_exptime_date',
+                 'imagetype', 'exptime', 'observation_date'),
+    )
 
     id = sa.Column(sa.Integer, primary_key=True)
     path = sa.Column(sa.Text, nullable=True)
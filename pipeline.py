@@ -0,0 +1,128 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+__all__ = ['run_pipeline', 'DEFAULT_QUEUE_DEPTH']
+
+#: Number of items each queue between two stages may hold.
+DEFAULT_QUEUE_DEPTH = 2
+
+# How often (in seconds) a blocked stage checks whether another stage failed.
+_POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+def _put(item_queue, item, stop):
+    """
+    Put ``item`` on a bounded queue, giving up if ``stop`` is set.
+    Returns whether the item was queued.
+    """
+    while not stop.is_set():
+        try:
+            item_queue.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(item_queue, stop):
+    """
+    Get the next item of a queue, or ``_DONE`` if ``stop`` is set first.
+    """
+    while not stop.is_set():
+        try:
+            return item_queue.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def run_pipeline(items, read, compute, write, depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Run ``write(compute(read(item)))`` for every item as three streaming
+    stages: a reader thread, the compute stage in the calling thread and a
+    writer thread.
+    The stages are connected by queues holding at most ``depth`` items, so
+    reading the next items and writing the previous ones overlap with the
+    computation while no more than about ``2 * depth + 3`` items are in
+    memory at once. Items are processed in order.
+    Parameters
+    ----------
+    items : iterable
+        Items passed to ``read``.
+    read, compute, write : callable
+        Stage functions; each one receives the return value of the
+        previous stage.
+    depth : int, optional
+        Size of the queues between stages.
+    Returns
+    -------
+    list
+        Return values of ``write``, in the order of ``items``.
+    Raises
+    ------
+    Any exception raised by a stage. The other stages are stopped and the
+    exception is raised again in the calling thread.
+    """
+    if depth < 1:
+        raise ValueError('depth must be at least 1')
+    read_queue = queue.Queue(maxsize=depth)
+    write_queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+    results = []
+
+    def reader():
+        try:
+            for item in items:
+                if not _put(read_queue, read(item), stop):
+                    return
+        except Exception:
+            errors.append(sys.exc_info()[1])
+            stop.set()
+        _put(read_queue, _DONE, stop)
+
+    def writer():
+        try:
+            while True:
+                value = _get(write_queue, stop)
+                if value is _DONE:
+                    return
+                results.append(write(value))
+        except Exception:
+            errors.append(sys.exc_info()[1])
+            stop.set()
+
+    threads = [threading.Thread(target=reader, name='pipeline-reader'),
+               threading.Thread(target=writer, name='pipeline-writer')]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            value = _get(read_queue, stop)
+            if value is _DONE:
+                break
+            if not _put(write_queue, compute(value), stop):
+                break
+        _put(write_queue, _DONE, stop)
+    except Exception:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
@@ -8,31 +8,62 @@ from astropy import units as u
 from astropy.io import fits
 import ccdproc
 
-def chooseClosestDark(darklists, exptime):
-    best_t = np.inf
-    for anexp in darklists.iterkeys():
-        if abs(anexp - exptime) < best_t:
-            best_t = anexp
-    return darklists[best_t]
-
-def combineBias(biaslist):
-    """Combine all the bias files into a master bias"""
+from combine import tiled_combine, calibration_transform
+from reduction import DarkIndex
+
+def combineBias(biaslist, mem_limit=None, processes=1, fast=False):
+    """Combine all the bias files into a master bias.
+
+    If any of mem_limit, processes or fast is set, the frames are combined
+    by combine.tiled_combine; see it for their meaning.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        return tiled_combine(biaslist, method='average', mem_limit=mem_limit,
+                             processes=processes, fast=fast, sigma_clip=True,
+                             sigma_clip_low_thresh=3,
+                             sigma_clip_high_thresh=3,
+                             sigma_clip_func=np.ma.median)
     ccdlist = [ccdproc.CCDData.read(abias, unit="adu") for abias in biaslist]
     biasComb = ccdproc.Combiner(ccdlist)
     biasComb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
     biasmaster = biasComb.average_combine()
     return biasmaster
 
-def combineDarks(darklist):
-    """Combine all the dark files into a master dark"""
+def combineDarks(darklist, mem_limit=None, processes=1, fast=False):
+    """Combine all the dark files into a master dark.
+
+    mem_limit, processes and fast: see combine.tiled_combine.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        darkmaster = tiled_combine(darklist, method='average',
+                                   mem_limit=mem_limit, processes=processes,
+                                   fast=fast, sigma_clip=True,
+                                   sigma_clip_low_thresh=3,
+                                   sigma_clip_high_thresh=3,
+                                   sigma_clip_func=np.ma.median)
+        darkmaster.header['exptime'] = fits.getval(darklist[0], 'exptime')
+        return darkmaster
     darkComb = ccdproc.Combiner([ccdproc.CCDData.read(adark, unit="adu") for adark in darklist])
     darkComb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
     darkmaster = darkComb.average_combine()
     darkmaster.header['exptime'] = fits.getval(darklist[0], 'exptime')
     return darkmaster
 
-def combineFlats(flatlist, dark=None, bias=None):
-    """Combine all flat files into a flat master. Subtract dark or bias if provided."""
+def combineFlats(flatlist, dark=None, bias=None, mem_limit=None,
+                 processes=1, fast=False):
+    """Combine all flat files into a flat master. Subtract dark or bias if provided.
+
+    mem_limit, processes and fast: see combine.tiled_combine, where dark
+    or bias are subtracted band by band.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        return tiled_combine(flatlist, method='average', mem_limit=mem_limit,
+                             processes=processes, fast=fast, sigma_clip=True,
+                             sigma_clip_low_thresh=3,
+                             sigma_clip_high_thresh=3,
+                             sigma_clip_func=np.ma.median,
+                             scale=lambda arr: 1./np.ma.average(arr),
+                             transform=calibration_transform(dark, bias))
     ccdflatlist = [ccdproc.CCDData.read(aflat, unit="adu") for aflat in flatlist]
     if dark is not None and bias is None:
         flat_sub = [ccdproc.subtract_dark(aflat, dark, exposure_time='exptime', exposure_unit=u.second) for aflat in ccdflatlist]
@@ -89,6 +120,8 @@ def preprocess(fits_path):
     #Create an image file collection storing the following keys
     keys = ['imagetyp', 'object', 'filter', 'exptime']
     allfits = ImageFileCollection('.', keywords=keys)
+    #Exposure times come from the summary so no file is opened just for them
+    exptimes = dict(zip(allfits.summary['file'], allfits.summary['exptime']))
 
     #Collect all dark files and make a dark frame for each different exposure time
     dark_matches = np.ma.array(['dark' in typ.lower() for typ in allfits.summary['imagetyp']])
@@ -107,14 +140,15 @@ def preprocess(fits_path):
 
     #Create the flat master
     flatlist = allfits.files_filtered(imagetyp='flat')
-    exptime = fits.getval(flatlist[0], 'exptime')
-    darkmaster = chooseClosestDark(darklists, exptime)
+    exptime = exptimes[flatlist[0]]
+    darkindex = DarkIndex(darklists)
+    darkmaster = darkindex.nearest(exptime)
     flatmaster = combineFlats(flatlist, dark=darkmaster)
 
     for ascience in sciencelist:
         sci_image = ccdproc.CCDData.read(ascience, unit='adu')
-        exp_time = fits.getval(ascience, 'exptime')
-        darkmaster = chooseClosestDark(darklists, exp_time)
+        exp_time = exptimes[ascience]
+        darkmaster = darkindex.nearest(exp_time)
         try:
             sci_darksub = ccdproc.subtract_dark(sci_image, darkmaster, exposure_time='exptime', exposure_unit=u.second)
             sci_flatcorrected = ccdproc.flat_correct(sci_darksub, flatmaster)
@@ -3,24 +3,61 @@ from astropy import units as u
 from astropy.io import fits
 import ccdproc
 
-def combineBias(biaslist):
-    """Combine all the bias files into a master bias"""
+from combine import tiled_combine, calibration_transform
+
+def combineBias(biaslist, mem_limit=None, processes=1, fast=False):
+    """Combine all the bias files into a master bias.
+
+    If any of mem_limit, processes or fast is set, the frames are combined
+    by combine.tiled_combine; see it for their meaning.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        return tiled_combine(biaslist, method='average', mem_limit=mem_limit,
+                             processes=processes, fast=fast, sigma_clip=True,
+                             sigma_clip_low_thresh=3,
+                             sigma_clip_high_thresh=3,
+                             sigma_clip_func=np.ma.median)
     ccdlist = [ccdproc.CCDData.read(abias, unit="adu") for abias in biaslist]
     biasComb = ccdproc.Combiner(ccdlist)
     biasComb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
     biasmaster = biasComb.average_combine()
     return biasmaster
 
-def combineDarks(darklist):
-    """Combine all the dark files into a master dark"""
+def combineDarks(darklist, mem_limit=None, processes=1, fast=False):
+    """Combine all the dark files into a master dark.
+
+    mem_limit, processes and fast: see combine.tiled_combine.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        darkmaster = tiled_combine(darklist, method='average',
+                                   mem_limit=mem_limit, processes=processes,
+                                   fast=fast, sigma_clip=True,
+                                   sigma_clip_low_thresh=3,
+                                   sigma_clip_high_thresh=3,
+                                   sigma_clip_func=np.ma.median)
+        darkmaster.header['exptime'] = fits.getval(darklist[0], 'exptime')
+        return darkmaster
     darkComb = ccdproc.Combiner([ccdproc.CCDData.read(adark, unit="adu") for adark in darklist])
     darkComb.sigma_clipping(low_thresh=3, high_thresh=3, func=np.ma.median)
     darkmaster = darkComb.average_combine()
     darkmaster.header['exptime'] = fits.getval(darklist[0], 'exptime')
     return darkmaster
 
-def combineFlats(flatlist, dark=None, bias=None):
-    """Combine all flat files into a flat master. Subtract dark or bias if provided."""
+def combineFlats(flatlist, dark=None, bias=None, mem_limit=None,
+                 processes=1, fast=False):
+    """Combine all flat files into a flat master. Subtract dark or bias if provided.
+
+    mem_limit, processes and fast: see combine.tiled_combine, where dark
+    or bias are subtracted band by band.
+    """
+    if mem_limit is not None or processes > 1 or fast:
+        return tiled_combine(flatlist, method='average', mem_limit=mem_limit,
+                             processes=processes, fast=fast, sigma_clip=True,
+                             sigma_clip_low_thresh=3,
+                             sigma_clip_high_thresh=3,
+                             sigma_clip_func=np.ma.median,
+                             scale=lambda arr: 1./np.ma.average(arr),
+                             transform=calibration_transform(dark, bias))
     ccdflatlist = [ccdproc.CCDData.read(aflat, unit="adu") for aflat in flatlist]
     if dark is not None and bias is None:
         flat_sub = [ccdproc.subtract_dark(aflat, dark, exposure_time='exptime', exposure_unit=u.second) for aflat in ccdflatlist]
@@ -0,0 +1,130 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+
+import models
+
+__all__ = ['nightly_summary', 'campaign_candidates', 'calibration_provenance',
+           'night_jd_range']
+
+# Julian date of 1970-01-01T00:00 UTC.
+_JD_UNIX_EPOCH = 2440587.5
+
+
+def night_jd_range(night):
+    """
+    Julian dates of the start and end of an observing night: from noon UTC
+    of ``night`` to noon UTC of the next day, so a whole night in the
+    Americas falls in one range.
+    Parameters
+    ----------
+    night : datetime.date or datetime.datetime
+        Date the night starts on, e.g. the date of its folder.
+    Returns
+    -------
+    (float, float)
+    """
+    if isinstance(night, datetime.datetime):
+        night = night.date()
+    start = _JD_UNIX_EPOCH + (night - datetime.date(1970, 1, 1)).days + 0.5
+    return start, start + 1
+
+
+def nightly_summary(session, night, campaign_id=None, with_sources=False):
+    """
+    Pawprints of a night, with what a report of the night shows loaded
+    along.
+    The state, campaign, CCD and observatory of each pawprint are joined
+    into the query of the pawprints; their state changes (and sources, if
+    asked for) are loaded with one more query per relationship for all
+    pawprints at once, instead of one per pawprint.
+    Parameters
+    ----------
+    session : sqlalchemy.orm.Session
+    night : datetime.date or datetime.datetime
+        Date the night starts on; see `night_jd_range`.
+    campaign_id : int, optional
+        Only pawprints of this campaign.
+    with_sources : bool, optional
+        Load ``Pawprint.sources`` too.
+    Returns
+    -------
+    list of models.Pawprint
+        In observing order.
+    """
+    sa.orm.configure_mappers()
+    Pawprint = models.Pawprint
+    start, end = night_jd_range(night)
+    campaign = joinedload(Pawprint.campaign)
+    options = [joinedload(Pawprint.state),
+               campaign.joinedload(models.Campaign.ccd),
+               campaign.joinedload(models.Campaign.observatory),
+               selectinload(Pawprint.statechanges)
+               .joinedload(models.StateChange.state)]
+    if with_sources:
+        options.append(selectinload(Pawprint.sources))
+    query = (session.query(Pawprint).options(*options)
+             .filter(Pawprint.jd >= start, Pawprint.jd < end))
+    if campaign_id is not None:
+        query = query.filter(Pawprint.campaign_id == campaign_id)
+    return query.order_by(Pawprint.jd, Pawprint.id).all()
+
+
+def campaign_candidates(session, campaign_id):
+    """
+    Candidates found in the pawprints of a campaign, with their pawprint,
+    its state and their stack loaded in the same query.
+    Parameters
+    ----------
+    session : sqlalchemy.orm.Session
+    campaign_id : int
+    Returns
+    -------
+    list of models.Candidate
+        In observing order of their pawprints.
+    """
+    sa.orm.configure_mappers()
+    Candidate, Pawprint = models.Candidate, models.Pawprint
+    return (session.query(Candidate)
+            .join(Candidate.pawprint)
+            .options(contains_eager(Candidate.pawprint)
+                     .joinedload(Pawprint.state),
+                     joinedload(Candidate.stack))
+            .filter(Pawprint.campaign_id == campaign_id)
+            .order_by(Pawprint.jd, Candidate.id)
+            .all())
+
+
+def calibration_provenance(session, imagetype=None, mastercal_ids=None):
+    """
+    Masters with the calibration frames combined into each, through
+    ``Combination``.
+    ``MasterCal.combinations`` and the ``CalFile`` of each combination are
+    loaded with one more query for all masters.
+    Parameters
+    ----------
+    session : sqlalchemy.orm.Session
+    imagetype : str, optional
+        Only masters of this image type, e.g. ``'dark'``.
+    mastercal_ids : list of int, optional
+        Only these masters.
+    Returns
+    -------
+    list of models.MasterCal
+        Most recent first.
+    """
+    sa.orm.configure_mappers()
+    MasterCal = models.MasterCal
+    query = session.query(MasterCal).options(
+        selectinload(MasterCal.combinations)
+        .joinedload(models.Combination.calfile))
+    if imagetype is not None:
+        query = query.filter(MasterCal.imagetype == imagetype)
+    if mastercal_ids is not None:
+        query = query.filter(MasterCal.id.in_(mastercal_ids))
+    return query.order_by(MasterCal.observation_date.desc(),
+                          MasterCal.id.desc()).all()
@@ -0,0 +1,221 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import bisect
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['calibrate', 'normalized_flat', 'working_array', 'DarkIndex']
+
+
+def working_array(ccd, dtype=np.float32):
+    """
+    Data of a master calibration frame as a plain array of ``dtype``.
+    Converting the masters once per night keeps the per-frame `calibrate`
+    call free of type conversions.
+    Parameters
+    ----------
+    ccd : ccdproc.CCDData or numpy.ndarray or None
+    dtype : numpy dtype, optional
+    Returns
+    -------
+    numpy.ndarray or None
+        ``None`` if ``ccd`` is ``None``.
+    """
+    if ccd is None:
+        return None
+    return np.asarray(_frame_data(ccd), dtype=dtype)
+
+
+def normalized_flat(flat, dtype=np.float32):
+    """
+    Master flat divided by its mean, as done by `ccdproc.flat_correct`.
+    Like `ccdproc.flat_correct`, masked pixels of the normalized flat are
+    set to one, so the science pixels under them are left unchanged by the
+    flat correction; pass the mask of the flat on to the reduced frame to
+    keep them flagged, as ccdproc does.
+    Parameters
+    ----------
+    flat : ccdproc.CCDData
+    dtype : numpy dtype, optional
+    Returns
+    -------
+    numpy.ndarray
+    """
+    # Normalize in double precision and only then convert, so the float32
+    # flat is the rounded version of the one ccdproc uses.
+    normed = flat.data / flat.data.mean()
+    mask = getattr(flat, 'mask', None)
+    if mask is not None and mask.any():
+        normed[mask] = 1.0
+    return normed.astype(dtype, copy=False)
+
+
+def calibrate(raw, flat, bias=None, dark=None, dark_scale=1.,
+              dtype=np.float32, overwrite_input=False):
+    """
+    Calibrate a science frame as ``(raw - bias - dark_scale * dark) / flat``.
+    This gives the same data as ``ccdproc.subtract_bias`` (or
+    ``subtract_dark``) followed by ``ccdproc.flat_correct``, but works on a
+    single buffer of ``dtype``: the frame is converted once and every step
+    is done in place, instead of each step allocating a new float64
+    `ccdproc.CCDData` with its mask and uncertainty. Use
+    ``dtype=np.float64`` to check results against ccdproc.
+    Parameters
+    ----------
+    raw : numpy.ndarray
+        Raw science data.
+    flat : numpy.ndarray
+        Normalized master flat, see `normalized_flat`.
+    bias, dark : numpy.ndarray, optional
+        Master bias and master dark to subtract, see `working_array`.
+    dark_scale : float, optional
+        Factor the dark is multiplied by before subtraction, e.g. the ratio
+        of the science and dark exposure times.
+    dtype : numpy dtype, optional
+        Type of the calibrated data. Default is ``np.float32``.
+    overwrite_input : bool, optional
+        If ``raw`` already has type ``dtype``, calibrate it in place instead
+        of working on a copy.
+    Returns
+    -------
+    numpy.ndarray
+        Calibrated data.
+    """
+    dtype = np.dtype(dtype)
+    if overwrite_input and raw.dtype == dtype:
+        data = raw
+    else:
+        data = raw.astype(dtype)
+    if bias is not None:
+        data -= bias
+    if dark is not None:
+        if dark_scale == 1:
+            data -= dark
+        else:
+            data -= dark * dtype.type(dark_scale)
+    data /= flat
+    return data
+
+
+class DarkIndex(object):
+
+    """
+    Master darks indexed by exposure time.
+    The exposure times are kept sorted, so the dark for a frame is found by
+    bisection. Depending on ``mode`` the dark returned by `dark` is
+    ``'nearest'``
+        the master with the closest exposure time, as is;
+    ``'scale'``
+        that master scaled to the exposure time of the frame;
+    ``'interpolate'``
+        interpolated linearly between the two masters whose exposure times
+        bracket the one of the frame (scaled from the nearest master outside
+        the range of exposure times).
+    A master with zero exposure time can't be scaled; when it is the
+    nearest one, it is returned as is.
+    Scaled and interpolated darks are computed once per exposure time and
+    reused for every frame with that exposure time.
+    Parameters
+    ----------
+    darks : dict
+        Master darks (``ccdproc.CCDData`` or arrays) by exposure time.
+    mode : str, optional
+        One of ``'nearest'`` (default), ``'scale'`` or ``'interpolate'``.
+    """
+
+    modes = ('nearest', 'scale', 'interpolate')
+
+    def __init__(self, darks, mode='nearest'):
+        if mode not in self.modes:
+            raise ValueError('mode must be one of {0}'.format(self.modes))
+        if not darks:
+            raise ValueError('no master darks given')
+        self._darks = dict(darks)
+        self._exptimes = sorted(self._darks)
+        self._mode = mode
+        self._prepared = {}
+
+    @property
+    def exptimes(self):
+        """
+        list, Sorted exposure times of the master darks.
+        """
+        return list(self._exptimes)
+
+    def nearest_exptime(self, exptime):
+        """
+        Exposure time of the master closest to ``exptime``; the shorter one
+        on ties.
+        """
+        idx = bisect.bisect_left(self._exptimes, exptime)
+        if idx == 0:
+            return self._exptimes[0]
+        if idx == len(self._exptimes):
+            return self._exptimes[-1]
+        below, above = self._exptimes[idx - 1], self._exptimes[idx]
+        return below if exptime - below <= above - exptime else above
+
+    def nearest(self, exptime):
+        """
+        Master dark with the exposure time closest to ``exptime``.
+        """
+        return self._darks[self.nearest_exptime(exptime)]
+
+    def dark(self, exptime):
+        """
+        Dark to subtract from a frame of exposure time ``exptime``, as
+        selected by the ``mode`` of the index.
+        """
+        if self._mode == 'nearest':
+            return self.nearest(exptime)
+        try:
+            return self._prepared[exptime]
+        except KeyError:
+            pass
+        idx = bisect.bisect_left(self._exptimes, exptime)
+        if (self._mode == 'interpolate' and
+                0 < idx < len(self._exptimes) and
+                self._exptimes[idx] != exptime):
+            below, above = self._exptimes[idx - 1], self._exptimes[idx]
+            weight = (exptime - below) / (above - below)
+            low = _frame_data(self._darks[below])
+            high = _frame_data(self._darks[above])
+            data = low + (high - low) * low.dtype.type(weight)
+            dark = _like(self._darks[below], data, exptime)
+        else:
+            anexp = self.nearest_exptime(exptime)
+            master = self._darks[anexp]
+            if anexp == exptime:
+                dark = master
+            elif anexp == 0:
+                logger.warning('Nearest dark to %ss has no exposure time, '
+                               'subtracting it unscaled', exptime)
+                dark = master
+            else:
+                data = _frame_data(master)
+                dark = _like(master, data * data.dtype.type(exptime / anexp),
+                             exptime)
+        self._prepared[exptime] = dark
+        return dark
+
+
+def _frame_data(frame):
+    if isinstance(frame, np.ndarray):
+        return frame
+    return np.asarray(frame.data)
+
+
+def _like(frame, data, exptime):
+    """
+    ``data`` wrapped like ``frame``: a plain array, or a CCDData with the
+    unit of ``frame`` and its header with ``exptime`` updated.
+    """
+    if isinstance(frame, np.ndarray):
+        return data
+    meta = frame.meta.copy()
+    meta['exptime'] = exptime
+    return type(frame)(data, unit=frame.unit, meta=meta)
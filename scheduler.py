@@ -0,0 +1,153 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import datetime
+import logging
+import uuid
+
+import sqlalchemy as sa
+
+import models
+from ingest import get_state_id
+
+logger = logging.getLogger(__name__)
+
+__all__ = ['Scheduler']
+
+
+class Scheduler(object):
+
+    """
+    Work queues of pawprints kept in the database.
+    The ``State`` of each ``Pawprint`` is its place in the pipeline. A
+    worker claims a batch of pawprints in one state by moving them to
+    another (e.g. from ``'raw'`` to ``'preprocessing'``), processes them and
+    then moves them on with `transition`. Every move updates the pawprints
+    with one statement and records their ``StateChange`` rows with one
+    executemany.
+    Claims are safe with many workers, in several processes or machines,
+    sharing one database: a pawprint is only claimed if it is still in the
+    state it was selected in, and each claim is tagged with a token in
+    ``Pawprint.claimed_by`` to read back which pawprints it won.
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        Engine of a database with the tables of `models`.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._state_ids = {}
+
+    def state_id(self, name):
+        """
+        Id of the ``State`` called ``name``, created if needed.
+        """
+        try:
+            return self._state_ids[name]
+        except KeyError:
+            pass
+        try:
+            with self._engine.begin() as connection:
+                state_id = get_state_id(connection, name)
+        except sa.exc.IntegrityError:
+            # another worker created the state at the same time
+            with self._engine.begin() as connection:
+                state_id = get_state_id(connection, name)
+        self._state_ids[name] = state_id
+        return state_id
+
+    def _record(self, connection, ids, state_id, now, paths=None):
+        """
+        Add the ``StateChange`` rows of moving ``ids`` to ``state_id``.
+        """
+        paths = paths or {}
+        connection.execute(models.StateChange.__table__.insert(), [
+            {'created_at': now, 'modified_at': now, 'count': 1,
+             'path': paths.get(pawprint_id), 'state_id': state_id,
+             'pawprint_id': pawprint_id}
+            for pawprint_id in ids])
+
+    def claim(self, state, claimed_state, batch_size=100):
+        """
+        Claim up to ``batch_size`` pawprints in ``state``, oldest first, by
+        moving them to ``claimed_state``.
+        Parameters
+        ----------
+        state : str
+            State of the pawprints to process, e.g. ``'raw'``.
+        claimed_state : str
+            State the claimed pawprints are in while being processed, e.g.
+            ``'preprocessing'``.
+        batch_size : int, optional
+        Returns
+        -------
+        list of int
+            Ids of the claimed pawprints; empty if there is no work left.
+        """
+        pawprints = models.Pawprint.__table__
+        from_id = self.state_id(state)
+        to_id = self.state_id(claimed_state)
+        token = uuid.uuid4().hex
+        now = datetime.datetime.now()
+        # The oldest pawprints in the state, through
+        # ix_Pawprint_state_modified. Databases that support it skip rows
+        # locked by other workers instead of waiting for them.
+        oldest = (sa.select(pawprints.c.id)
+                  .where(pawprints.c.state_id == from_id)
+                  .order_by(pawprints.c.modified_at, pawprints.c.id)
+                  .limit(batch_size)
+                  .with_for_update(skip_locked=True))
+        with self._engine.begin() as connection:
+            # A single UPDATE, so the claim is atomic also on SQLite; the
+            # state check leaves out rows another worker claimed first.
+            connection.execute(
+                pawprints.update()
+                .where(pawprints.c.id.in_(oldest))
+                .where(pawprints.c.state_id == from_id)
+                .values(state_id=to_id, claimed_by=token, modified_at=now))
+            claimed = [row.id for row in connection.execute(
+                sa.select(pawprints.c.id)
+                .where(pawprints.c.state_id == to_id)
+                .where(pawprints.c.claimed_by == token))]
+            if claimed:
+                self._record(connection, claimed, to_id, now)
+        logger.debug('Claimed %d pawprints from %s', len(claimed), state)
+        return claimed
+
+    def transition(self, ids, state, paths=None):
+        """
+        Move pawprints to ``state``, e.g. once they are processed or when
+        they failed, and release their claim.
+        Parameters
+        ----------
+        ids : list of int
+            Ids of the pawprints.
+        state : str
+            New state.
+        paths : dict, optional
+            Path of the file of each pawprint in the new state, by id; it is
+            stored in the ``StateChange`` rows.
+        """
+        if not ids:
+            return
+        pawprints = models.Pawprint.__table__
+        to_id = self.state_id(state)
+        now = datetime.datetime.now()
+        with self._engine.begin() as connection:
+            connection.execute(
+                pawprints.update()
+                .where(pawprints.c.id.in_(ids))
+                .values(state_id=to_id, claimed_by=None, modified_at=now))
+            self._record(connection, ids, to_id, now, paths)
+
+    def count(self, state):
+        """
+        Number of pawprints in ``state``.
+        """
+        pawprints = models.Pawprint.__table__
+        with self._engine.connect() as connection:
+            return connection.execute(
+                sa.select(sa.func.count())
+                .select_from(pawprints)
+                .where(pawprints.c.state_id == self.state_id(state))).scalar()
@@ -0,0 +1,142 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import sqlalchemy as sa
+from astropy import units as u
+from astropy_healpix import HEALPix, lonlat_to_healpix
+
+__all__ = ['healpix_index', 'pixel_ranges', 'cone_search', 'update_healpix',
+           'HEALPIX_ORDER']
+
+#: Order of the HEALPix pixels stored in the ``healpix`` columns, in the
+#: nested scheme. Pixels are about 13 arcsec across.
+HEALPIX_ORDER = 14
+
+# Width in degrees of a HEALPix pixel of order 0.
+_ORDER0_RESOLUTION = np.degrees(np.sqrt(4 * np.pi / 12))
+
+
+def healpix_index(ra, dec):
+    """
+    HEALPix pixel (nested scheme, order `HEALPIX_ORDER`) of sky positions.
+    Parameters
+    ----------
+    ra, dec : float or numpy.ndarray
+        Coordinates in degrees.
+    Returns
+    -------
+    int or numpy.ndarray of int64
+    """
+    pixels = lonlat_to_healpix(np.asarray(ra, dtype=float) * u.deg,
+                               np.asarray(dec, dtype=float) * u.deg,
+                               2 ** HEALPIX_ORDER, order='nested')
+    pixels = np.asarray(pixels, dtype=np.int64)
+    return pixels if pixels.ndim else int(pixels)
+
+
+def pixel_ranges(ra, dec, radius):
+    """
+    Ranges of `HEALPIX_ORDER` pixels covering a cone.
+    The cone is covered with coarser pixels, about a quarter of the radius
+    across,
+    and each of them is the range of its nested sub-pixels. Adjacent ranges
+    are merged, so a cone becomes a handful of index range scans.
+    Parameters
+    ----------
+    ra, dec, radius : float
+        Center and radius of the cone, in degrees.
+    Returns
+    -------
+    list of (int, int)
+        Inclusive ``(first, last)`` pixel ranges.
+    """
+    order = HEALPIX_ORDER
+    if radius > 0:
+        order = int(np.floor(np.log2(4 * _ORDER0_RESOLUTION / radius)))
+        order = min(max(order, 0), HEALPIX_ORDER)
+    coarse = HEALPix(nside=2 ** order, order='nested')
+    pixels = np.sort(coarse.cone_search_lonlat(ra * u.deg, dec * u.deg,
+                                               radius * u.deg))
+    shift = 4 ** (HEALPIX_ORDER - order)
+    ranges = []
+    for pixel in pixels.tolist():
+        first, last = pixel * shift, (pixel + 1) * shift - 1
+        if ranges and ranges[-1][1] + 1 == first:
+            ranges[-1] = (ranges[-1][0], last)
+        else:
+            ranges.append((first, last))
+    return ranges
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    """
+    Angular distance in degrees, with the haversine formula.
+    """
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    sin_ddec = np.sin((dec2 - dec1) / 2)
+    sin_dra = np.sin((ra2 - ra1) / 2)
+    hav = sin_ddec ** 2 + np.cos(dec1) * np.cos(dec2) * sin_dra ** 2
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1))))
+
+
+def cone_search(session, model, ra, dec, radius):
+    """
+    Rows of ``model`` within ``radius`` degrees of ``(ra, dec)``.
+    The rows are first selected by their ``healpix`` column, using the
+    ranges of `pixel_ranges`, and only their coordinates are read to check
+    the exact angular distance; just the rows inside the cone are then
+    loaded as instances.
+    Parameters
+    ----------
+    session : sqlalchemy.orm.Session
+    model : class
+        Mapped class with ``ra``, ``dec`` and ``healpix`` columns, such as
+        ``models.Source`` or ``models.Candidate``.
+    ra, dec, radius : float
+        Center and radius of the cone, in degrees.
+    Returns
+    -------
+    list
+        Instances of ``model``, closest first.
+    """
+    ranges = pixel_ranges(ra, dec, radius)
+    column = model.healpix
+    rows = session.query(model.id, model.ra, model.dec).filter(sa.or_(*[
+        column.between(first, last) for first, last in ranges])).all()
+    if not rows:
+        return []
+    ids, ras, decs = zip(*rows)
+    distance = _separation(ra, dec, np.array(ras), np.array(decs))
+    inside = np.flatnonzero(distance <= radius)
+    inside = inside[np.argsort(distance[inside], kind='mergesort')]
+    if not len(inside):
+        return []
+    matches = [ids[idx] for idx in inside]
+    by_id = dict((row.id, row) for row in
+                 session.query(model).filter(model.id.in_(matches)))
+    return [by_id[row_id] for row_id in matches]
+
+
+def update_healpix(engine, table, batch_size=20000):
+    """
+    Fill in the ``healpix`` column of the rows of ``table`` that lack it,
+    e.g. rows inserted before the column existed.
+    Returns the number of rows updated.
+    """
+    update = table.update().where(table.c.id == sa.bindparam('row_id'))
+    updated = 0
+    with engine.begin() as connection:
+        while True:
+            rows = connection.execute(
+                table.select().where(table.c.healpix.is_(None))
+                .limit(batch_size)).fetchall()
+            if not rows:
+                return updated
+            ids = [row.id for row in rows]
+            pixels = healpix_index(np.array([row.ra for row in rows]),
+                                   np.array([row.dec for row in rows]))
+            connection.execute(update, [
+                {'row_id': row_id, 'healpix': pixel}
+                for row_id, pixel in zip(ids, pixels.tolist())])
+            updated += len(rows)
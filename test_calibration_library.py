@@ -0,0 +1,39 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+import models
+from calibration_library import CalibrationLibrary
+from ingest import ingest_frames
+
+
+def _header(path, exptime):
+    return {'file': path, 'imagetyp': 'Flat Field', 'exptime': exptime,
+            'date-obs': '2015-09-16T23:00:00', 'ccd-temp': -20.,
+            'xbinning': 1, 'ybinning': 1}
+
+
+def test_add_records_input_exptimes_and_reuses_ingested_frames():
+    engine = sa.create_engine('sqlite://')
+    models.Model.metadata.create_all(engine)
+    ingest_frames(engine, [_header('/night/flat0.fit', 5.)])
+    session = Session(engine)
+    library = CalibrationLibrary(session)
+
+    library.add('/night/flat_master.fits', 'flat',
+                datetime.datetime(2015, 9, 16, 23),
+                calfiles=[('/night/flat0.fit', 5.),
+                          ('/night/flat1.fit', 5.)])
+
+    calfiles = session.query(models.CalFile).order_by(models.CalFile.id).all()
+    assert [(calfile.path, calfile.imagetype, calfile.exptime)
+            for calfile in calfiles] == [('/night/flat0.fit', 'flat', 5),
+                                         ('/night/flat1.fit', 'flat', 5)]
+    master, = session.query(models.MasterCal).all()
+    assert master.exptime is None
+    assert [combination.calfile for combination in master.combinations] == \
+        calfiles
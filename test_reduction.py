@@ -0,0 +1,91 @@
+from __future__ import (print_function, division, absolute_import,
+                        unicode_literals)
+
+import numpy as np
+import ccdproc
+
+import mainscript
+from reduction import calibrate, normalized_flat, working_array, DarkIndex
+
+
+def _frame(data, mask=None):
+    return ccdproc.CCDData(np.asarray(data, dtype=np.float64), unit='adu',
+                           mask=mask, meta={'exptime': 10.})
+
+
+def test_calibrate_matches_ccdproc_with_masked_flat():
+    rng = np.random.RandomState(0)
+    raw = _frame(rng.uniform(1000, 2000, (20, 30)))
+    bias = _frame(rng.uniform(90, 110, (20, 30)))
+    flat_mask = np.zeros((20, 30), dtype=bool)
+    flat_mask[3, 4] = flat_mask[10, :5] = True
+    flat = _frame(rng.uniform(0.5, 1.5, (20, 30)), mask=flat_mask)
+
+    expected = ccdproc.flat_correct(ccdproc.subtract_bias(raw, bias), flat)
+    data = calibrate(raw.data, normalized_flat(flat, np.float64),
+                     bias=working_array(bias, np.float64), dtype=np.float64)
+
+    np.testing.assert_allclose(data, expected.data, rtol=1e-12)
+    # masked flat pixels are not flat corrected, in both paths
+    np.testing.assert_allclose(data[flat_mask],
+                               (raw.data - bias.data)[flat_mask])
+
+
+def test_fast_reduction_keeps_flat_mask():
+    rng = np.random.RandomState(1)
+    raw = _frame(rng.uniform(1000, 2000, (8, 8)))
+    bias = _frame(rng.uniform(90, 110, (8, 8)))
+    flat_mask = np.zeros((8, 8), dtype=bool)
+    flat_mask[2, 2] = True
+    flat = _frame(rng.uniform(0.5, 1.5, (8, 8)), mask=flat_mask)
+
+    expected = mainscript.reduceScience(raw, flat, biasmaster=bias)
+    prepared = mainscript.prepareMasters(flat, biasmaster=bias,
+                                         dtype=np.float64)
+    reduced = mainscript.reduceScienceFast(raw.copy(), prepared)
+
+    np.testing.assert_allclose(reduced.data, expected.data, rtol=1e-12)
+    np.testing.assert_array_equal(reduced.mask, expected.mask)
+
+
+def _darks():
+    return dict((exptime, np.full((4, 5), 2. * exptime + 1.))
+                for exptime in [10., 30., 60.])
+
+
+def test_dark_index_nearest():
+    index = DarkIndex(_darks())
+    assert index.exptimes == [10., 30., 60.]
+    assert index.nearest_exptime(5.) == 10.
+    assert index.nearest_exptime(45.) == 30.  # ties go to the shorter one
+    assert index.nearest_exptime(50.) == 60.
+    assert index.nearest_exptime(100.) == 60.
+    np.testing.assert_array_equal(index.dark(25.), _darks()[30.])
+
+
+def test_dark_index_scale():
+    index = DarkIndex(_darks(), mode='scale')
+    np.testing.assert_allclose(index.dark(20.), _darks()[10.] * 2.)
+    np.testing.assert_array_equal(index.dark(30.), _darks()[30.])
+    assert index.dark(20.) is index.dark(20.)
+
+
+def test_dark_index_interpolate():
+    index = DarkIndex(_darks(), mode='interpolate')
+    np.testing.assert_allclose(index.dark(20.), 41.)
+    np.testing.assert_allclose(index.dark(45.), 91.)
+    # outside the range of exposure times the nearest master is scaled
+    np.testing.assert_allclose(index.dark(120.), _darks()[60.] * 2.)
+    np.testing.assert_allclose(index.dark(5.), _darks()[10.] / 2.)
+
+
+def test_dark_index_zero_exptime_dark_is_not_scaled():
+    darks = {0.: np.full((4, 5), 3.), 60.: np.full((4, 5), 121.)}
+    index = DarkIndex(darks, mode='scale')
+    np.testing.assert_array_equal(index.dark(5.), darks[0.])
+    np.testing.assert_allclose(index.dark(50.), 121. * 50. / 60.)
+    # between two masters a zero exposure time is interpolated from
+    index = DarkIndex(darks, mode='interpolate')
+    np.testing.assert_allclose(index.dark(15.), 3. + 118. / 4.)
+    index = DarkIndex({0.: darks[0.]}, mode='interpolate')
+    np.testing.assert_array_equal(index.dark(100.), darks[0.])
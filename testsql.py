@@ -4,21 +4,14 @@
 import os
 import datetime
 
-from sqlalchemy.orm import sessionmaker
 from astropy.io import fits
 
 #from toritos import models
 import models
+from db import Database
 
-import sqlalchemy as sa
-
-engine = sa.create_engine('sqlite:///toritos-dev.db', echo=True)
-Session = sessionmaker()
-Session.configure(bind=engine)
-
-models.Model.metadata.create_all(engine)
-
-session = Session()
+database = Database(create_tables=True)
+session = database.Session()
 
 macon = models.Observatory()
 macon.name = 'Macon ridge'